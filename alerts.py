@@ -0,0 +1,276 @@
+import asyncio
+import os
+import threading
+import time
+from requests import HTTPError
+import forecast_cache
+import get_weather
+import shared_store
+
+#weather.gov alerts, kept off the page request path. A permanent cache maps locations to their county and forecast
+#zones, one shared poller fetches the active alerts for every zone somebody is watching, and the alerts are kept in
+#an index by zone. Pages subscribe to a location and are called back whenever its set of alerts changes.
+
+zone_cache_path = os.environ.get('ALERT_ZONE_CACHE', '.alert_zones.sqlite')
+#Locations share zone lookups within cells of this many degrees, about 1 km
+zone_grid = 0.01
+#Seconds between polls of the active alerts
+poll_interval = 60
+#Zones per /alerts/active request, which takes a comma separated list
+zones_per_request = 50
+#Alerts are listed most severe first
+severity_order = {'Extreme': 0, 'Severe': 1, 'Moderate': 2, 'Minor': 3}
+
+
+#Zone ID from a weather.gov zone URL, e.g. https://api.weather.gov/zones/county/PAC101 -> PAC101
+def zone_id(zone_url):
+    return zone_url.rstrip('/').rsplit('/', 1)[-1] if zone_url else ''
+
+
+#Persistent grid cell -> zone IDs. Outside the US the list is empty, which is cached too.
+class ZoneCache():
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._connection = None
+        if path:
+            self._connection = shared_store.connect(path)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS alert_zones (cell TEXT PRIMARY KEY, zones TEXT)')
+            self._connection.commit()
+            for (cell, zones) in self._connection.execute('SELECT cell, zones FROM alert_zones'):
+                self._entries[cell] = tuple(zone for zone in zones.split(',') if zone)
+
+    @staticmethod
+    def cell(lat, lon):
+        return '%.2f,%.2f' % forecast_cache.quantize(lat, lon, zone_grid)
+
+    #Cells not in memory are looked up in the file too, where other worker processes may have put them
+    def get(self, lat, lon):
+        cell = self.cell(lat, lon)
+        zones = self._entries.get(cell)
+        if zones is not None or self._connection is None:
+            return zones
+        with self._lock:
+            row = self._connection.execute('SELECT zones FROM alert_zones WHERE cell = ?', (cell,)).fetchone()
+            if row is None:
+                return None
+            zones = self._entries[cell] = tuple(zone for zone in row[0].split(',') if zone)
+        return zones
+
+    def put(self, lat, lon, zones):
+        cell = self.cell(lat, lon)
+        with self._lock:
+            self._entries[cell] = tuple(zones)
+            if self._connection is not None:
+                self._connection.execute('INSERT OR REPLACE INTO alert_zones VALUES (?, ?)', (cell, ','.join(zones)))
+                self._connection.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+#Blocking points lookup of the county and forecast zones for a location. Raises unless weather.gov gave an answer,
+#so errors are never cached as a location without zones.
+def fetch_zones(lat, lon):
+    try:
+        point = get_weather.get_weather_gov_weather(round(lat, 4), round(lon, 4))
+    except HTTPError as e:
+        #Points outside the US are a 404, and have no zones
+        if e.response is not None and e.response.status_code == 404:
+            return []
+        raise
+    if 'properties' not in point:
+        raise ValueError('weather.gov points answer without properties')
+    properties = point['properties']
+    zones = [zone_id(properties.get('county')), zone_id(properties.get('forecastZone'))]
+    return [zone for zone in dict.fromkeys(zones) if zone]
+
+
+#The parts of an alert the page shows
+def summarize(feature):
+    properties = feature.get('properties', {})
+    return {'id': properties.get('id') or feature.get('id'), 'event': properties.get('event', ''),
+            'headline': properties.get('headline') or properties.get('event', ''),
+            'severity': properties.get('severity', ''), 'expires': properties.get('expires', '')}
+
+
+def alert_zones(feature):
+    properties = feature.get('properties', {})
+    zones = properties.get('geocode', {}).get('UGC') or [zone_id(url) for url in properties.get('affectedZones', [])]
+    return [zone for zone in zones if zone]
+
+
+class AlertService():
+    def __init__(self, zone_cache=None):
+        self._zone_cache = zone_cache
+        #zone -> {alert id: summary}, for the zones being polled
+        self.index = {}
+        self.polls = 0
+        self.zone_lookups = 0
+        self._subscribers = {}
+        self._next_token = 0
+        self._resolving = {}
+        #token -> (lat, lon) of subscribers whose zone lookup failed, retried on the next full poll
+        self._failed_lookups = {}
+        self._poll_now = None
+        self._task = None
+
+    @property
+    def zone_cache(self):
+        if self._zone_cache is None:
+            self._zone_cache = ZoneCache(zone_cache_path)
+        return self._zone_cache
+
+    def active_zones(self):
+        return {zone for (zones, callback, last) in self._subscribers.values() for zone in zones or ()}
+
+    #Alerts for a list of zones, without duplicates, most severe first
+    def alerts_for(self, zones):
+        alerts = {}
+        for zone in zones:
+            alerts.update(self.index.get(zone, {}))
+        return sorted(alerts.values(), key=lambda alert: severity_order.get(alert['severity'], len(severity_order)))
+
+    #Alerts for a location when its zones and their alerts are known, else None
+    def known_alerts(self, lat, lon):
+        zones = self.zone_cache.get(lat, lon)
+        if zones is None or any(zone not in self.index for zone in zones):
+            return None
+        return self.alerts_for(zones)
+
+    #Calls callback(alerts) now if the location's alerts are known and again whenever they change.
+    #Returns a token for unsubscribe.
+    def subscribe(self, lat, lon, callback):
+        token = self._next_token
+        self._next_token += 1
+        zones = self.zone_cache.get(lat, lon)
+        self._subscribers[token] = [zones, callback, None]
+        if zones is None:
+            self._resolve(token, lat, lon)
+        else:
+            self._deliver(token)
+            if any(zone not in self.index for zone in zones):
+                self._wake_poller()
+        return token
+
+    def unsubscribe(self, token):
+        self._subscribers.pop(token, None)
+        self._failed_lookups.pop(token, None)
+
+    #Looks the zones up in the background, sharing one lookup between subscribers in the same grid cell
+    def _resolve(self, token, lat, lon):
+        cell = ZoneCache.cell(lat, lon)
+        if cell not in self._resolving:
+            self._resolving[cell] = (set(), asyncio.create_task(self._lookup_zones(cell, lat, lon)))
+        self._resolving[cell][0].add(token)
+
+    async def _lookup_zones(self, cell, lat, lon):
+        try:
+            self.zone_lookups += 1
+            zones = await asyncio.to_thread(fetch_zones, lat, lon)
+            await asyncio.to_thread(self.zone_cache.put, lat, lon, zones)
+        except Exception as e:
+            print('Alert zone lookup failed:', e)
+            zones = None
+        (tokens, task) = self._resolving.pop(cell)
+        for token in tokens:
+            if token in self._subscribers:
+                if zones is None:
+                    self._failed_lookups[token] = (lat, lon)
+                    continue
+                self._subscribers[token][0] = zones
+                #Zones another cell already watches are indexed, so their alerts need no poll
+                self._deliver(token)
+        self._wake_poller()
+
+    def _deliver(self, token):
+        (zones, callback, last) = self._subscribers[token]
+        if zones is None or any(zone not in self.index for zone in zones):
+            return
+        alerts = self.alerts_for(zones)
+        ids = [alert['id'] for alert in alerts]
+        if ids != last:
+            self._subscribers[token][2] = ids
+            try:
+                callback(alerts)
+            except Exception as e:
+                print('Alert subscriber problem:', e)
+
+    def _wake_poller(self):
+        if self._poll_now is not None:
+            self._poll_now.set()
+
+    def start(self):
+        if self._task is None:
+            self.zone_cache
+            self._poll_now = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    #Polls every watched zone each poll_interval. When woken early, only the zones nobody has polled yet are fetched.
+    async def _run(self):
+        next_poll = 0
+        while True:
+            try:
+                await asyncio.wait_for(self._poll_now.wait(), timeout=max(next_poll - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            self._poll_now.clear()
+            try:
+                if time.monotonic() >= next_poll:
+                    next_poll = time.monotonic() + poll_interval
+                    await self.poll()
+                else:
+                    await self.poll(new_only=True)
+            except Exception as e:
+                print('Alert polling problem:', e)
+
+    #Fetches the active alerts for the watched zones and notifies the subscribers whose alerts changed
+    async def poll(self, new_only=False):
+        if not new_only:
+            self._retry_failed_lookups()
+        zones = self.active_zones()
+        if new_only:
+            zones = {zone for zone in zones if zone not in self.index}
+        else:
+            for zone in list(self.index):
+                if zone not in zones:
+                    del self.index[zone]
+        zones = sorted(zones)
+        if not zones:
+            return
+        chunks = [zones[start:start + zones_per_request] for start in range(0, len(zones), zones_per_request)]
+        results = await asyncio.gather(*[asyncio.to_thread(get_weather.get_alerts_gov_weather_zone, ','.join(chunk))
+                                         for chunk in chunks], return_exceptions=True)
+        self.polls += 1
+        for (chunk, result) in zip(chunks, results):
+            if isinstance(result, BaseException):
+                print('Alert poll failed for', len(chunk), 'zones:', result)
+                continue
+            by_zone = {zone: {} for zone in chunk}
+            for feature in result.get('features', []):
+                alert = summarize(feature)
+                for zone in alert_zones(feature):
+                    if zone in by_zone:
+                        by_zone[zone][alert['id']] = alert
+            self.index.update(by_zone)
+        for token in list(self._subscribers):
+            self._deliver(token)
+
+    def _retry_failed_lookups(self):
+        failed = self._failed_lookups
+        self._failed_lookups = {}
+        for (token, (lat, lon)) in failed.items():
+            if token in self._subscribers:
+                self._resolve(token, lat, lon)
+
+    def stats(self):
+        return {'subscribers': len(self._subscribers), 'zones': len(self.active_zones()), 'polls': self.polls,
+                'zone_lookups': self.zone_lookups, 'cached_cells': len(self.zone_cache)}
+
+
+service = AlertService()
@@ -0,0 +1,123 @@
+import asyncio
+import get_weather
+import forecast_cache
+import forecast_model
+import geocoding
+import provider_router
+import single_flight
+import units
+
+#Awaitable versions of the get_weather providers. The blocking requests calls run in worker threads so the
+#NiceGUI event loop keeps serving other clients while a forecast is being fetched. Identical calls that are already
+#in flight, e.g. many clients opening the same city at once, share one upstream request.
+
+coalescer = single_flight.SingleFlight()
+
+
+#Runs func in a worker thread, joining an identical call that is already running
+async def _coalesced(key, func, *args):
+    return await coalescer.do(key, asyncio.to_thread, func, *args)
+
+
+#Forecast calls are keyed like the forecast cache, so users in the same grid cell share a single fetch
+async def _coalesced_forecast(func, lat, lon, units):
+    return await _coalesced((func.__name__, *forecast_cache.quantize(lat, lon), units), func, lat, lon, units)
+
+
+def coalescing_stats():
+    return coalescer.stats()
+
+
+#Resolves a search from the geocoding cache or gazetteer when possible, which needs no thread or network round-trip
+async def geocode(location_string='', place_name='', state_name='', country_name='', zip_code=''):
+    query = geocoding.query_from_parts(location_string, place_name, state_name, country_name, zip_code)
+    result = geocoding.lookup(query)
+    if result is not None:
+        return result
+    return await _coalesced(('geocode', query), geocoding.geocode,
+                            location_string, place_name, state_name, country_name, zip_code)
+
+
+async def reverse_geocode(lat, lon):
+    result = geocoding.reverse_lookup(lat, lon)
+    if result is not None:
+        return result
+    return await _coalesced(('reverse_geocode', lat, lon), geocoding.reverse_geocode, lat, lon)
+
+
+async def get_open_weather_five_day_forcast(lat, lon, units='imperial'):
+    return await _coalesced_forecast(get_weather.get_open_weather_five_day_forcast, lat, lon, units)
+
+
+async def get_open_weather_current_weather(lat, lon, units='imperial'):
+    return await _coalesced_forecast(get_weather.get_open_weather_current_weather, lat, lon, units)
+
+
+async def get_location(ip_address=None):
+    return await _coalesced(('get_location', ip_address), get_weather.get_location, ip_address)
+
+
+async def get_openmeteo_current_weather(lat, lon, temp_unit='fahrenheit'):
+    return await _coalesced_forecast(get_weather.get_openmeteo_current_weather, lat, lon, temp_unit)
+
+
+async def get_openmeteo_weather(lat, lon, temp_unit='fahrenheit'):
+    return await _coalesced_forecast(get_weather.get_openmeteo_weather, lat, lon, temp_unit)
+
+
+#Refetches a forecast cache entry, joining a user request for the same data that is already in flight
+async def refresh_forecast(key):
+    func = forecast_cache.providers[key[0]][0]
+    return await _coalesced((func.__name__, key[1], key[2], key[3]), forecast_cache.refresh, key)
+
+
+#Refetches many forecast cache entries, batching the providers that accept several locations per request
+async def refresh_forecasts(keys):
+    return await asyncio.to_thread(forecast_cache.refresh_many, keys)
+
+
+#Fills the forecast cache for many (lat, lon) locations, e.g. the most searched places at startup
+async def warm_forecasts(data_type, coordinates, units):
+    return await asyncio.to_thread(forecast_cache.warm, data_type, coordinates, units)
+
+
+#Fetches the forecasts for a location concurrently, so the wait is roughly the slowest single upstream call.
+#Current conditions and the daily forecast can each come from OpenWeather or Open-Meteo; provider_router hedges
+#between them and falls back to a cached value still within its stale window. Forecasts come back in the canonical
+#unit, see units.py.
+#Returns (current, hourly, daily) as forecast_model objects
+async def get_forecasts(lat, lon, temp_scale=units.canonical_scale):
+    open_weather_units = get_weather.open_weather_units[temp_scale]
+    open_meteo_units = get_weather.open_meteo_units[temp_scale]
+
+    async def daily_from_open_weather():
+        return forecast_model.daily_from_hourly(await get_open_weather_five_day_forcast(lat, lon, open_weather_units))
+
+    return await asyncio.gather(
+        provider_router.router.fetch(
+            [('open_weather', lambda: get_open_weather_current_weather(lat, lon, units=open_weather_units)),
+             ('open_meteo', lambda: get_openmeteo_current_weather(lat, lon, open_meteo_units))],
+            _last_known('current', lat, lon, open_weather_units)),
+        provider_router.router.fetch(
+            [('open_weather', lambda: get_open_weather_five_day_forcast(lat, lon, units=open_weather_units))],
+            _last_known('hourly', lat, lon, open_weather_units)),
+        provider_router.router.fetch(
+            [('open_meteo', lambda: get_openmeteo_weather(lat, lon, open_meteo_units)),
+             ('open_weather', daily_from_open_weather)],
+            _last_known('daily', lat, lon, open_meteo_units)))
+
+
+#The forecasts get_forecasts would return, when all three are in the forecast cache, else None. Answers on the
+#event loop without any worker thread or provider call.
+def cached_forecasts(lat, lon, temp_scale=units.canonical_scale):
+    cache = forecast_cache.default_cache
+    open_weather_units = get_weather.open_weather_units[temp_scale]
+    forecasts = (forecast_cache.peek(cache.key('current', lat, lon, open_weather_units)),
+                 forecast_cache.peek(cache.key('hourly', lat, lon, open_weather_units)),
+                 forecast_cache.peek(cache.key('daily', lat, lon, get_weather.open_meteo_units[temp_scale])))
+    return None if None in forecasts else forecasts
+
+
+def _last_known(data_type, lat, lon, units):
+    cache = forecast_cache.default_cache
+    return lambda: cache.last_known(cache.key(data_type, lat, lon, units))
@@ -0,0 +1,74 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+#Startup benchmark. Imports main in fresh interpreters with -X importtime and reports the median wall time of the
+#whole import, the time spent importing this app's own modules and the slowest imports below main, so regressions
+#in worker start time show up before they reach production.
+#   python benchmarks/import_time.py [--runs 10] [--top 15] [--module main]
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+#Modules that are part of this app rather than third party packages
+app_modules = {file_name[:-3] for file_name in os.listdir(repo_dir) if file_name.endswith('.py')}
+
+
+#[(self microseconds, cumulative microseconds, depth, module)] from -X importtime output
+def parse_importtime(stderr):
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        (self_us, cumulative_us, name) = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return imports
+
+
+def run_once(module):
+    environment = dict(os.environ)
+    #The app must import without its secrets, which are only read on first use
+    environment.pop('OPEN_WEATHER_API_KEY', None)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=repo_dir,
+                            env=environment, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f'Importing {module} failed:\n{result.stderr[-2000:]}')
+    return (wall, parse_importtime(result.stderr))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time a cold import of the app')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--module', default='main')
+    args = parser.parse_args()
+
+    walls = []
+    totals = []
+    own = []
+    cumulative = {}
+    for i in range(args.runs):
+        (wall, imports) = run_once(args.module)
+        walls.append(wall)
+        totals.append(sum(self_us for (self_us, cumulative_us, depth, name) in imports))
+        own.append(sum(self_us for (self_us, cumulative_us, depth, name) in imports if name in app_modules))
+        for (self_us, cumulative_us, depth, name) in imports:
+            cumulative.setdefault(name, []).append(cumulative_us)
+
+    print(f'{args.runs} cold imports of {args.module}')
+    print(f'  process wall time   {statistics.median(walls) * 1000:8.1f} ms (median)')
+    print(f'  all imports         {statistics.median(totals) / 1000:8.1f} ms')
+    print(f'  this app\'s modules  {statistics.median(own) / 1000:8.1f} ms (self time)')
+    print(f'Slowest imports, cumulative median:')
+    slowest = sorted(((statistics.median(times), name) for (name, times) in cumulative.items()
+                      if name != args.module and '.' not in name), reverse=True)
+    for (cumulative_us, name) in slowest[:args.top]:
+        print(f'  {cumulative_us / 1000:8.1f} ms  {name}{" (app)" if name in app_modules else ""}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import contextlib
+import importlib
+import httpx
+from nicegui import core, ui
+from nicegui.storage import set_storage_secret
+from nicegui.testing import User
+from nicegui.testing.general import nicegui_reset_globals, prepare_simulation
+from nicegui.testing.user_interaction import UserInteraction
+import stub_upstreams
+
+#Load test of the weather page against local stand-ins for every upstream API, see stub_upstreams.py. Simulated
+#NiceGUI clients open the page and then keep searching for places, switching units and sending browser locations,
+#each waiting for its page to show the result. Reports throughput, p50/p95/p99 page update latency per flow, upstream
+#call counts and how far the event loop fell behind, so changes can be compared under the same load.
+#   python benchmarks/load_test.py [--clients 20] [--duration 30] [--latency open_meteo=0.3] \
+#       [--errors open_weather=0.05] [--json]
+#The clients run in this process through NiceGUI's user simulation, so no browser or server port is involved.
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+#Relative weight of each flow after a client's page is open
+flow_weights = {'search': 5, 'toggle': 3, 'location': 2}
+temperature_scales = ('F', 'C', 'K')
+#How often waiting clients look at their page, and the event loop monitor's tick, in seconds
+poll_interval = 0.002
+lag_interval = 0.01
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+#Seconds the event loop started late for each lag_interval sleep
+async def monitor_loop_lag(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(lag_interval)
+        lags.append(max(0.0, time.perf_counter() - start - lag_interval))
+
+
+class SimulatedClient():
+    def __init__(self, number, user, places, args):
+        self.number = number
+        self.user = user
+        self.places = places
+        self.args = args
+        self.random = random.Random(f'{args.seed}-{number}')
+        self.browser_location = None
+        #Answers the page's geolocation request with whatever the current flow set
+        user.javascript_rules[re.compile(r'.*navigator\.geolocation', re.DOTALL)] = \
+            lambda match: {'latitude': self.browser_location[0], 'longitude': self.browser_location[1]}
+
+    #The label right after 'Location: ', and the big temperature label of the Today card
+    def find_labels(self):
+        caption = self.user.find(kind=ui.label, content='Location: ').elements.pop()
+        siblings = caption.parent_slot.children
+        self.location_label = siblings[siblings.index(caption) + 1]
+        self.temperature_label = next(element for element in self.user.find(kind=ui.label).elements
+                                      if 'text-h4' in element.classes)
+
+    async def wait_for(self, condition):
+        deadline = time.perf_counter() + self.args.timeout
+        while not condition():
+            if time.perf_counter() > deadline:
+                raise TimeoutError
+            await asyncio.sleep(poll_interval)
+
+    async def open(self):
+        await self.user.open('/')
+        self.find_labels()
+        await self.wait_for(lambda: self.location_label.text)
+
+    async def search(self):
+        shown = self.location_label.text
+        place = self.random.choice([place for place in self.places if not shown.startswith(place['name'])])
+        self.user.find(ui.input).clear().type(f'{place["name"]}, {place["state_code"]}').trigger('keydown.enter')
+        await self.wait_for(lambda: self.location_label.text.startswith(place['name']))
+
+    async def toggle(self):
+        toggle = self.user.find(ui.toggle).elements.pop()
+        shown = self.temperature_label.text
+        with self.user.client:
+            toggle.set_value(self.random.choice([scale for scale in temperature_scales if scale != toggle.value]))
+        await self.wait_for(lambda: self.temperature_label.text != shown)
+
+    async def location(self):
+        shown = self.location_label.text
+        place = self.random.choice([place for place in self.places if not shown.startswith(place['name'])])
+        #A few hundred metres off, like a real fix, so the reverse geocoder still names the same place
+        self.browser_location = (place['lat'] + self.random.uniform(-0.004, 0.004),
+                                 place['lon'] + self.random.uniform(-0.004, 0.004))
+        button = next(element for element in self.user.find(kind=ui.button).elements
+                      if element.props.get('icon') == 'location_on')
+        UserInteraction(self.user, {button}, None).click()
+        await self.wait_for(lambda: self.location_label.text.startswith(place['name']))
+
+    async def run(self, results, stop):
+        await self.timed('open', results, self.open)
+        while not stop.is_set():
+            flow = self.random.choices(list(flow_weights), weights=list(flow_weights.values()))[0]
+            await self.timed(flow, results, getattr(self, flow))
+            if self.args.think > 0:
+                await asyncio.sleep(self.random.expovariate(1 / self.args.think))
+
+    async def timed(self, flow, results, action):
+        start = time.perf_counter()
+        try:
+            await action()
+        except TimeoutError:
+            results[flow]['timeouts'] += 1
+            return
+        except Exception as e:
+            print(f'Client {self.number} {flow} problem:', repr(e), file=sys.stderr)
+            results[flow]['errors'] += 1
+            return
+        results[flow]['latencies'].append(time.perf_counter() - start)
+
+
+#Points the app at the stand-ins and keeps its caches out of the working tree. Must run before the app is imported.
+def configure_app(base_urls, scratch_dir):
+    os.environ.update(base_urls)
+    os.environ.setdefault('OPEN_WEATHER_API_KEY', 'load test')
+    #Every client sends its own X-Forwarded-For, standing in for a proxy
+    os.environ['TRUST_X_FORWARDED_FOR'] = '1'
+    for name in ('GEOCODE_CACHE', 'ALERT_ZONE_CACHE', 'FORECAST_CACHE_DISK', 'GAZETTEER_CSV', 'IP_LOCATION_CSV'):
+        os.environ[name] = ''
+    os.environ['TILE_CACHE_DIR'] = os.path.join(scratch_dir, 'tiles')
+    sys.path.insert(0, repo_dir)
+    import http_sessions
+    http_sessions.cache_name = os.path.join(scratch_dir, 'responses')
+
+
+def remote_stats(stub_url, path):
+    return httpx.get(stub_url.rstrip('/') + path, timeout=5).json()
+
+
+#Like nicegui.testing.user_simulation, but main is imported instead of run as a script, so ui.run is never called and
+#the page's ui.colors at module level does not count as a script mode UI
+@contextlib.asynccontextmanager
+async def simulated_app():
+    with nicegui_reset_globals():
+        os.environ['NICEGUI_USER_SIMULATION'] = 'true'
+        try:
+            importlib.import_module('main')
+            prepare_simulation()
+            set_storage_secret('load test')
+            async with core.app.router.lifespan_context(core.app):
+                yield
+        finally:
+            os.environ.pop('NICEGUI_USER_SIMULATION', None)
+
+
+async def run_clients(args, places, stub):
+    results = collections.defaultdict(lambda: {'latencies': [], 'errors': 0, 'timeouts': 0})
+    lags = []
+    stop = asyncio.Event()
+    async with simulated_app():
+        import async_weather
+        import forecast_cache
+        #Own cookies, so every client has its own user storage, and its own address for the IP lookup
+        users = [User(httpx.AsyncClient(transport=httpx.ASGITransport(core.app), base_url='http://test',
+                                        headers={'X-Forwarded-For': f'11.{i // 256 % 256}.{i % 256}.1'}))
+                 for i in range(args.clients)]
+        clients = [SimulatedClient(i, user, places, args) for (i, user) in enumerate(users)]
+        monitor = asyncio.create_task(monitor_loop_lag(lags, stop))
+        cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        asyncio.get_running_loop().call_later(args.duration, stop.set)
+        await asyncio.gather(*(client.run(results, stop) for client in clients))
+        elapsed = time.perf_counter() - start
+        cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+        stop.set()
+        await monitor
+        for user in users:
+            await user.http_client.aclose()
+        return {
+            'clients': args.clients,
+            'seconds': elapsed,
+            'cpu_seconds': (cpu_end.ru_utime - cpu_start.ru_utime) + (cpu_end.ru_stime - cpu_start.ru_stime),
+            'flows': {flow: summarize(result, elapsed) for (flow, result) in sorted(results.items())},
+            'loop_lag': {'p50': percentile(lags, 0.5), 'p99': percentile(lags, 0.99), 'max': max(lags, default=0.0)},
+            'upstream': remote_stats(args.stub_url, '/_stats') if stub is None else stub.stats(),
+            'forecast_cache': forecast_cache.default_cache.stats(),
+            'coalescing': async_weather.coalescing_stats(),
+        }
+
+
+def summarize(result, elapsed):
+    latencies = result['latencies']
+    return {'completed': len(latencies), 'errors': result['errors'], 'timeouts': result['timeouts'],
+            'per_second': len(latencies) / elapsed, 'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95), 'p99': percentile(latencies, 0.99),
+            'mean': statistics.fmean(latencies) if latencies else float('nan')}
+
+
+def print_report(report):
+    completed = sum(flow['completed'] for flow in report['flows'].values())
+    print(f'{report["clients"]} clients for {report["seconds"]:.1f} s: {completed} page updates, '
+          f'{completed / report["seconds"]:.1f}/s, {report["cpu_seconds"]:.1f} s CPU')
+    print(f'  {"flow":10} {"done":>6} {"err":>4} {"t/o":>4} {"/s":>7} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for (name, flow) in report['flows'].items():
+        print(f'  {name:10} {flow["completed"]:6} {flow["errors"]:4} {flow["timeouts"]:4} {flow["per_second"]:7.1f} '
+              f'{flow["p50"] * 1000:8.1f} {flow["p95"] * 1000:8.1f} {flow["p99"] * 1000:8.1f}')
+    lag = report['loop_lag']
+    print(f'Event loop lag: p50 {lag["p50"] * 1000:.1f} ms, p99 {lag["p99"] * 1000:.1f} ms, '
+          f'max {lag["max"] * 1000:.1f} ms')
+    calls = report['upstream']['calls']
+    errors = report['upstream']['errors']
+    print('Upstream calls: ' + (', '.join(f'{provider} {count}' + (f' ({errors[provider]} failed)'
+                                                                     if errors.get(provider) else '')
+                                           for (provider, count) in sorted(calls.items())) or 'none'))
+    print('Forecast cache:', report['forecast_cache'])
+    print('Coalescing:', report['coalescing'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the weather page against local upstream stand-ins')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load after the pages start opening')
+    parser.add_argument('--think', type=float, default=0.5, help='mean seconds a client waits between flows')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds a page may take to show a result')
+    parser.add_argument('--stub-url', default='',
+                        help='use stub_upstreams.py already running at this URL instead of starting one here')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--verbose', action='store_true', help='show what the app prints while under load')
+    stub_upstreams.add_arguments(parser)
+    args = parser.parse_args()
+
+    places = stub_upstreams.load_payload('places.json')
+    stub = None
+    if args.stub_url:
+        url = httpx.URL(args.stub_url)
+        base_urls = stub_upstreams.base_urls(url.host, url.port)
+        remote_stats(args.stub_url, '/_reset')
+    else:
+        stub = stub_upstreams.from_arguments(args).start()
+        base_urls = stub.base_urls()
+    with tempfile.TemporaryDirectory(prefix='weather-load-test-') as scratch_dir:
+        configure_app(base_urls, scratch_dir)
+        #The app's pages resolve their static files and icons relative to the working directory
+        os.chdir(repo_dir)
+        try:
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+                report = asyncio.run(run_clients(args, places, stub))
+        finally:
+            if stub is not None:
+                stub.stop()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import stub_upstreams
+
+#Benchmark of worker processes sharing the forecast cache, see shared_store.py. Each process looks up the current
+#weather and five day forecast of random places as fast as it can, against the local stand-ins in stub_upstreams.py,
+#with a short time to live so entries keep expiring during the run. With a shared cache file the upstream calls should
+#stay about the same however many processes there are, while lookups per second grow with them. With separate caches,
+#every process fetches every place itself.
+#   python benchmarks/shared_cache.py [--workers 1,2,4] [--duration 10] [--ttl 3] \
+#       [--latency open_weather=0.05] [--separate]
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+#Data types looked up, through the cached get_weather function for each
+lookups = {'current': 'get_open_weather_current_weather', 'hourly': 'get_open_weather_five_day_forcast'}
+
+
+#Runs in each worker process. The app modules are imported here, after the environment points them at the stand-ins.
+def run_worker(number, base_urls, disk_path, places, args, start_at, results):
+    os.environ.update(base_urls)
+    os.environ.setdefault('OPEN_WEATHER_API_KEY', 'benchmark')
+    os.environ['FORECAST_CACHE_DISK'] = disk_path
+    sys.path.insert(0, repo_dir)
+    import forecast_cache
+    import get_weather
+    for data_type in lookups:
+        forecast_cache.default_cache.ttls[data_type] = args.ttl
+    functions = [getattr(get_weather, name) for name in lookups.values()]
+    generator = random.Random(f'{args.seed}-{number}')
+    count = 0
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        place = generator.choice(places)
+        generator.choice(functions)(place['lat'], place['lon'])
+        count += 1
+    results.put({'lookups': count, 'forecast_cache': forecast_cache.default_cache.stats()})
+
+
+def run(workers, shared, stub, places, args, scratch_dir):
+    stub.reset()
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    disk_path = os.path.join(scratch_dir, f'forecast-{workers}.sqlite') if shared else ''
+    #Far enough ahead for every process to have started and imported the app
+    start_at = time.time() + 3
+    processes = [context.Process(target=run_worker,
+                                 args=(number, stub.base_urls(), disk_path, places, args, start_at, results))
+                 for number in range(workers)]
+    for process in processes:
+        process.start()
+    reports = [results.get() for process in processes]
+    for process in processes:
+        process.join()
+    total = sum(report['lookups'] for report in reports)
+    return {'workers': workers, 'shared': shared, 'lookups': total, 'per_second': total / args.duration,
+            'upstream_calls': sum(stub.stats()['calls'].values()),
+            'peer_fills': sum(report['forecast_cache'].get('peer_fills', 0) for report in reports)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark worker processes sharing the forecast cache')
+    parser.add_argument('--workers', default='1,2,4', help='comma separated process counts to run')
+    parser.add_argument('--duration', type=float, default=10, help='seconds each run looks up forecasts')
+    parser.add_argument('--ttl', type=float, default=3, help='seconds a forecast stays fresh')
+    parser.add_argument('--places', type=int, default=10, help='look up the first this many places, 0 for all')
+    parser.add_argument('--separate', action='store_true', help='also run with a separate cache per process')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    stub_upstreams.add_arguments(parser)
+    args = parser.parse_args()
+
+    places = stub_upstreams.load_payload('places.json')[:args.places or None]
+    stub = stub_upstreams.from_arguments(args).start()
+    reports = []
+    try:
+        with tempfile.TemporaryDirectory(prefix='weather-shared-cache-') as scratch_dir:
+            for workers in [int(count) for count in args.workers.split(',')]:
+                for shared in ((True, False) if args.separate else (True,)):
+                    reports.append(run(workers, shared, stub, places, args, scratch_dir))
+    finally:
+        stub.stop()
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+    print(f'{len(places)} places for {args.duration:.0f} s each, {args.ttl:g} s TTL')
+    print(f'  {"workers":>7} {"cache":8} {"lookups/s":>10} {"upstream":>9} {"peer fills":>10}')
+    for report in reports:
+        print(f'  {report["workers"]:7} {"shared" if report["shared"] else "separate":8} '
+              f'{report["per_second"]:10.0f} {report["upstream_calls"]:9} {report["peer_fills"]:10}')
+
+
+if __name__ == '__main__':
+    main()
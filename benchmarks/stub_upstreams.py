@@ -0,0 +1,344 @@
+import argparse
+import collections
+import copy
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import flatbuffers
+import numpy as np
+
+#Local stand-ins for the upstream APIs get_weather calls, for load tests. One server answers for every provider under
+#its own path prefix, replaying the recorded payloads in benchmarks/payloads with their timestamps moved to today.
+#Point the app at it with the environment variables from base_urls(), e.g.
+#OPEN_WEATHER_URL=http://127.0.0.1:8100/openweather. Each provider can be given a latency and an error rate, and the
+#server counts the calls it gets per provider.
+#   python benchmarks/stub_upstreams.py --port 8100 --latency open_meteo=0.3 --errors open_weather=0.05
+
+payload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payloads')
+#Path prefix per provider, named like the http_sessions providers
+provider_prefixes = {
+    'open_weather': '/openweather',
+    'open_weather_tiles': '/openweather_tiles',
+    'open_meteo': '/openmeteo',
+    'weather_gov': '/weathergov',
+    'ipify': '/ipify',
+    'ipapi': '/ipapi',
+}
+#get_weather environment variable per provider
+provider_environment = {
+    'open_weather': 'OPEN_WEATHER_URL',
+    'open_weather_tiles': 'OPEN_WEATHER_TILE_URL',
+    'open_meteo': 'OPEN_METEO_URL',
+    'weather_gov': 'WEATHER_GOV_URL',
+    'ipify': 'IPIFY_URL',
+    'ipapi': 'IPAPI_URL',
+}
+seconds_per_day = 24 * 60 * 60
+#1x1 transparent PNG served for every map tile
+tile_png = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                         '1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082')
+
+
+def load_payload(name):
+    with open(os.path.join(payload_dir, name), encoding='utf-8') as payload_file:
+        return json.load(payload_file)
+
+
+def base_urls(host, port):
+    return {provider_environment[provider]: f'http://{host}:{port}{prefix}'
+            for (provider, prefix) in provider_prefixes.items()}
+
+
+#Whole days between a recorded timestamp and now, so replayed forecasts keep their time of day but start today
+def day_shift(recorded_time, now=None):
+    return int(((now or time.time()) - recorded_time) // seconds_per_day * seconds_per_day)
+
+
+#Recorded temperatures are Celsius; works on floats and NumPy arrays alike
+def convert_celsius(value, units):
+    if units in ('imperial', 'fahrenheit'):
+        return np.round(value * 9 / 5 + 32, 2)
+    if units == 'standard':
+        return np.round(value + 273.15, 2)
+    return value
+
+
+#Stable made up coordinates in the contiguous US for a place that is not in places.json
+def made_up_coordinates(name):
+    digest = hashlib.sha256(name.lower().encode()).digest()
+    return (round(30 + digest[0] / 255 * 15, 4), round(-120 + digest[1] / 255 * 45, 4))
+
+
+#One size prefixed Open-Meteo FlatBuffers message, the format openmeteo_requests decodes. sections maps
+#'current', 'daily' or 'hourly' to (start, end, interval, [values]), values being a float for current and an array
+#for the other two.
+def encode_open_meteo(lat, lon, utc_offset, sections):
+    builder = flatbuffers.Builder(4096)
+    section_offsets = {}
+    for (name, (start, end, interval, columns)) in sections.items():
+        variables = []
+        for values in columns:
+            vector = None
+            if name != 'current':
+                vector = builder.CreateNumpyVector(np.asarray(values, dtype=np.float32))
+            builder.StartObject(13)
+            if vector is None:
+                builder.PrependFloat32Slot(2, float(values), 0.0)
+            else:
+                builder.PrependUOffsetTRelativeSlot(3, vector, 0)
+            variables.append(builder.EndObject())
+        builder.StartVector(4, len(variables), 4)
+        for variable in reversed(variables):
+            builder.PrependUOffsetTRelative(variable)
+        vector = builder.EndVector()
+        builder.StartObject(4)
+        builder.PrependInt64Slot(0, int(start), 0)
+        builder.PrependInt64Slot(1, int(end), 0)
+        builder.PrependInt32Slot(2, int(interval), 0)
+        builder.PrependUOffsetTRelativeSlot(3, vector, 0)
+        section_offsets[name] = builder.EndObject()
+    builder.StartObject(16)
+    builder.PrependFloat32Slot(0, lat, 0.0)
+    builder.PrependFloat32Slot(1, lon, 0.0)
+    builder.PrependInt32Slot(6, int(utc_offset), 0)
+    for (name, slot) in (('current', 9), ('daily', 10), ('hourly', 11)):
+        if name in section_offsets:
+            builder.PrependUOffsetTRelativeSlot(slot, section_offsets[name], 0)
+    builder.FinishSizePrefixed(builder.EndObject())
+    return bytes(builder.Output())
+
+
+class StubUpstreams():
+    def __init__(self, latencies=None, error_rates=None, error_status=502, jitter=0.25, seed=None):
+        #provider -> seconds added to every response, and fraction of requests answered with error_status
+        self.latencies = dict(latencies or {})
+        self.error_rates = dict(error_rates or {})
+        self.error_status = error_status
+        #Latencies vary by up to this fraction either way
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+        self.payloads = {name[:-len('.json')]: load_payload(name)
+                         for name in os.listdir(payload_dir) if name.endswith('.json')}
+        self.places = {place['name'].lower(): place for place in self.payloads['places']}
+        self.server = None
+        self._thread = None
+
+    def start(self, host='127.0.0.1', port=0):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name='stub upstreams', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def base_urls(self):
+        return base_urls(self.server.server_address[0], self.port)
+
+    def stats(self):
+        with self._lock:
+            return {'calls': dict(self.calls), 'errors': dict(self.errors)}
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+
+    def handle(self, request):
+        url = urllib.parse.urlsplit(request.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == '/_stats':
+            return self._send(request, 200, json.dumps(self.stats()).encode(), 'application/json')
+        if url.path == '/_reset':
+            self.reset()
+            return self._send(request, 200, b'{}', 'application/json')
+        for (provider, prefix) in provider_prefixes.items():
+            if url.path.startswith(prefix + '/') or url.path == prefix:
+                break
+        else:
+            return self._send(request, 404, b'{"message": "unknown path"}', 'application/json')
+        with self._lock:
+            self.calls[provider] += 1
+            failed = self.random.random() < self.error_rates.get(provider, 0)
+            latency = self.latencies.get(provider, 0) * (1 + self.jitter * (2 * self.random.random() - 1))
+            if failed:
+                self.errors[provider] += 1
+        if latency > 0:
+            time.sleep(latency)
+        if failed:
+            return self._send(request, self.error_status, b'{"message": "injected error"}', 'application/json')
+        try:
+            (body, content_type) = getattr(self, '_' + provider)(url.path[len(prefix):], query)
+        except LookupError as e:
+            return self._send(request, 404, json.dumps({'message': str(e)}).encode(), 'application/json')
+        except Exception as e:
+            print('Stub upstream problem:', repr(e))
+            return self._send(request, 500, json.dumps({'message': repr(e)}).encode(), 'application/json')
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self._send(request, 200, body, content_type)
+
+    def _send(self, request, status, body, content_type):
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _place(self, name):
+        place = self.places.get(name.strip().lower())
+        if place is None:
+            (lat, lon) = made_up_coordinates(name)
+            place = {'name': name.strip().title(), 'state': '', 'country': 'US', 'lat': lat, 'lon': lon}
+        return place
+
+    def _nearest_place(self, lat, lon):
+        return min(self.payloads['places'], key=lambda place: (place['lat'] - lat) ** 2 + (place['lon'] - lon) ** 2)
+
+    def _open_weather(self, path, query):
+        units = query.get('units', ['standard'])[0]
+        if path == '/geo/1.0/direct':
+            place = self._place(query['q'][0].split(',')[0])
+            return ([dict(self.payloads['open_weather_direct'][0], local_names={'en': place['name']},
+                          **{key: place[key] for key in ('name', 'state', 'country', 'lat', 'lon')})],
+                    'application/json')
+        if path == '/geo/1.0/zip':
+            return (dict(self.payloads['open_weather_zip'], zip=query['zip'][0].split(',')[0]), 'application/json')
+        if path == '/geo/1.0/reverse':
+            (lat, lon) = (float(query['lat'][0]), float(query['lon'][0]))
+            place = self._nearest_place(lat, lon)
+            return ([dict(self.payloads['open_weather_reverse'][0], name=place['name'],
+                          local_names={'en': place['name']}, state=place['state'], lat=lat, lon=lon)],
+                    'application/json')
+        if path == '/data/2.5/weather':
+            payload = copy.deepcopy(self.payloads['open_weather_current'])
+            payload['dt'] += day_shift(payload['dt'])
+            for field in ('temp', 'feels_like', 'temp_min', 'temp_max'):
+                payload['main'][field] = float(convert_celsius(payload['main'][field], units))
+            return (payload, 'application/json')
+        if path == '/data/2.5/forecast':
+            payload = copy.deepcopy(self.payloads['open_weather_forecast'])
+            shift = day_shift(payload['list'][0]['dt'])
+            for entry in payload['list']:
+                entry['dt'] += shift
+                for field in ('temp', 'feels_like', 'temp_min', 'temp_max'):
+                    entry['main'][field] = float(convert_celsius(entry['main'][field], units))
+            return (payload, 'application/json')
+        raise LookupError(path)
+
+    def _open_weather_tiles(self, path, query):
+        return (tile_png, 'image/png')
+
+    def _open_meteo(self, path, query):
+        if path != '/v1/forecast':
+            raise LookupError(path)
+        #requests sends lists as repeated parameters, the Open-Meteo docs use commas; both are accepted
+        def values(name):
+            return [part for value in query.get(name, []) for part in value.split(',') if part]
+        units = query.get('temperature_unit', ['celsius'])[0]
+        recorded = self.payloads['open_meteo']
+        shift = day_shift(recorded['daily']['time'][0])
+        sections = {}
+        if values('current'):
+            current = recorded['current']
+            sections['current'] = (current['time'] + shift, current['time'] + shift + current['interval'],
+                                   current['interval'],
+                                   [self._open_meteo_value(variable, current[variable], units)
+                                    for variable in values('current')])
+        if values('daily'):
+            daily = recorded['daily']
+            start = daily['time'][0] + shift
+            sections['daily'] = (start, start + len(daily['time']) * seconds_per_day, seconds_per_day,
+                                 [self._open_meteo_value(variable, np.asarray(daily[variable], dtype=np.float64), units)
+                                  for variable in values('daily')])
+        messages = [encode_open_meteo(float(lat), float(lon), recorded['utc_offset_seconds'], sections)
+                    for (lat, lon) in zip(values('latitude'), values('longitude'))]
+        return (b''.join(messages), 'application/octet-stream')
+
+    @staticmethod
+    def _open_meteo_value(variable, value, units):
+        return convert_celsius(value, units) if 'temperature' in variable else value
+
+    def _weather_gov(self, path, query):
+        if path.startswith('/points/'):
+            return (self.payloads['weather_gov_points'], 'application/geo+json')
+        if path == '/alerts/active':
+            return (self.payloads['weather_gov_alerts'], 'application/geo+json')
+        raise LookupError(path)
+
+    def _ipify(self, path, query):
+        return (self.payloads['ipify'], 'application/json')
+
+    def _ipapi(self, path, query):
+        return (dict(self.payloads['ipapi'], ip=path.strip('/').split('/')[0]), 'application/json')
+
+
+#'open_meteo=0.3' -> ('open_meteo', 0.3)
+def provider_value(text):
+    (provider, value) = text.split('=', 1)
+    if provider not in provider_prefixes:
+        raise argparse.ArgumentTypeError(f'unknown provider {provider!r}, '
+                                         f'expected one of {", ".join(provider_prefixes)}')
+    return (provider, float(value))
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=provider_value, action='append', default=[], metavar='PROVIDER=SECONDS',
+                        help='added latency per response')
+    parser.add_argument('--jitter', type=float, default=0.25, help='latency varies by this fraction either way')
+    parser.add_argument('--errors', type=provider_value, action='append', default=[], metavar='PROVIDER=FRACTION',
+                        help='fraction of requests answered with --error-status')
+    parser.add_argument('--error-status', type=int, default=502)
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def from_arguments(args):
+    return StubUpstreams(dict(args.latency), dict(args.errors), args.error_status, args.jitter, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-ins for the weather app upstream APIs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    stub = from_arguments(args).start(args.host, args.port)
+    for (name, url) in stub.base_urls().items():
+        print(f'{name}={url}')
+    print(f'Call counts at http://{args.host}:{stub.port}/_stats')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
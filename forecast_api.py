@@ -0,0 +1,172 @@
+import collections
+import gzip
+import hashlib
+import json
+import time
+from fastapi import HTTPException, Query, Request, Response
+from nicegui import app
+import alerts
+import async_weather
+import units
+
+#Headless JSON API on the page's own caches, for dashboards and scripts that only want the data:
+#   /api/forecast?lat=&lon=&units=   current conditions, hourly and daily forecasts and weather.gov alerts
+#   /api/geocode?q=                  a search resolved to a name and coordinates
+#Every response carries an ETag, and a request sending it back in If-None-Match gets an empty 304 until the data
+#changes. Encoded bodies, gzipped ones included, are kept per set of cached forecasts, so a poll of a cached location
+#neither serializes nor compresses anything.
+
+#Seconds clients may reuse a response before asking again
+forecast_max_age = 60
+geocode_max_age = 24 * 60 * 60
+#Smaller bodies are sent uncompressed, like NiceGUI's own gzip middleware does
+gzip_min_size = 500
+body_cache_max_entries = 1024
+#Seconds a location stays on the alert poller's watch list after its last API request
+alert_watch_seconds = 10 * 60
+#Locations on that watch list at most, the least recently requested being dropped first. Each one costs weather.gov
+#requests, and anyone can ask for any location.
+alert_watch_max_entries = 256
+#Names accepted for units besides F, C and K
+unit_aliases = {'imperial': 'F', 'metric': 'C', 'standard': 'K'}
+
+
+#A JSON body with its ETag and, once somebody asks for it, its gzipped version
+class EncodedBody():
+    __slots__ = ('body', 'etag', '_gzipped')
+
+    def __init__(self, document):
+        self.body = json.dumps(document, separators=(',', ':')).encode()
+        self.etag = '"' + hashlib.blake2b(self.body, digest_size=12).hexdigest() + '"'
+        self._gzipped = None
+
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=6)
+        return self._gzipped
+
+
+#key -> (forecasts, EncodedBody), least recently used first. The forecasts are held so their ids in the key stay valid.
+_forecast_bodies = collections.OrderedDict()
+#geocode result -> EncodedBody
+_geocode_bodies = collections.OrderedDict()
+#alert cell -> (subscription token, watched until)
+_alert_watches = collections.OrderedDict()
+requests_served = 0
+not_modified = 0
+
+
+def _remember(bodies, key, value):
+    bodies[key] = value
+    bodies.move_to_end(key)
+    while len(bodies) > body_cache_max_entries:
+        bodies.popitem(last=False)
+
+
+def _etag_matches(if_none_match, etag):
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
+
+#True when Accept-Encoding lists gzip, or *, without q=0
+def _accepts_gzip(accept_encoding):
+    for coding in accept_encoding.lower().split(','):
+        (name, *parameters) = [part.strip() for part in coding.split(';')]
+        if name in ('gzip', '*'):
+            for parameter in parameters:
+                if parameter.replace(' ', '').startswith('q='):
+                    try:
+                        return float(parameter.split('=', 1)[1]) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+
+def _respond(request, encoded, max_age):
+    global requests_served, not_modified
+    requests_served += 1
+    headers = {'ETag': encoded.etag, 'Cache-Control': f'public, max-age={max_age}', 'Vary': 'Accept-Encoding'}
+    if _etag_matches(request.headers.get('if-none-match', ''), encoded.etag):
+        not_modified += 1
+        return Response(status_code=304, headers=headers)
+    if len(encoded.body) >= gzip_min_size and _accepts_gzip(request.headers.get('accept-encoding', '')):
+        #Already encoded, so the gzip middleware passes it through untouched
+        headers['Content-Encoding'] = 'gzip'
+        return Response(content=encoded.gzipped(), media_type='application/json', headers=headers)
+    return Response(content=encoded.body, media_type='application/json', headers=headers)
+
+
+#Keeps the location's zones polled while API clients ask for it, for up to alert_watch_max_entries locations.
+#Returns its alerts, or None while they are unknown.
+def _watch_alerts(lat, lon, now=None):
+    now = now or time.monotonic()
+    while _alert_watches and next(iter(_alert_watches.values()))[1] <= now:
+        (cell, (token, until)) = _alert_watches.popitem(last=False)
+        alerts.service.unsubscribe(token)
+    cell = alerts.ZoneCache.cell(lat, lon)
+    if cell in _alert_watches:
+        token = _alert_watches.pop(cell)[0]
+    else:
+        token = alerts.service.subscribe(lat, lon, lambda active_alerts: None)
+    _alert_watches[cell] = (token, now + alert_watch_seconds)
+    while len(_alert_watches) > alert_watch_max_entries:
+        (dropped_cell, (dropped_token, until)) = _alert_watches.popitem(last=False)
+        alerts.service.unsubscribe(dropped_token)
+    return alerts.service.known_alerts(lat, lon)
+
+
+def _forecast_document(lat, lon, scale, current, hourly, daily, active_alerts):
+    return {'lat': lat, 'lon': lon, 'units': scale,
+            'current': current.to_dict(scale), 'hourly': hourly.to_dict(scale), 'daily': daily.to_dict(scale),
+            'alerts': active_alerts}
+
+
+@app.get('/api/forecast')
+async def forecast(request: Request, lat: float = Query(ge=-90, le=90), lon: float = Query(ge=-180, le=180),
+                   scale: str = Query(units.canonical_scale, alias='units')):
+    scale = unit_aliases.get(scale.lower(), scale.upper())
+    if scale not in units.temperature_scales:
+        raise HTTPException(status_code=422, detail='units must be one of F, C, K, imperial, metric or standard')
+    forecasts = async_weather.cached_forecasts(lat, lon)
+    if forecasts is None:
+        try:
+            forecasts = tuple(await async_weather.get_forecasts(lat, lon))
+        except Exception as e:
+            print('Forecast API problem:', e)
+            raise HTTPException(status_code=502, detail='Could not fetch the forecast')
+    active_alerts = _watch_alerts(lat, lon)
+    key = (lat, lon, scale, *map(id, forecasts),
+           None if active_alerts is None else tuple(alert['id'] for alert in active_alerts))
+    entry = _forecast_bodies.get(key)
+    if entry is None or any(held is not forecast for (held, forecast) in zip(entry[0], forecasts)):
+        entry = (forecasts, EncodedBody(_forecast_document(lat, lon, scale, *forecasts, active_alerts)))
+        _remember(_forecast_bodies, key, entry)
+    else:
+        _forecast_bodies.move_to_end(key)
+    return _respond(request, entry[1], forecast_max_age)
+
+
+@app.get('/api/geocode')
+async def geocode(request: Request, q: str = Query(min_length=1, max_length=200)):
+    try:
+        result = await async_weather.geocode(q)
+    except ValueError:
+        raise HTTPException(status_code=404, detail='Location not found')
+    except Exception as e:
+        print('Geocode API problem:', e)
+        raise HTTPException(status_code=502, detail='Could not geocode the location')
+    document = {key: result.get(key) for key in ('name', 'lat', 'lon')}
+    key = tuple(document.items())
+    encoded = _geocode_bodies.get(key)
+    if encoded is None:
+        encoded = EncodedBody(document)
+        _remember(_geocode_bodies, key, encoded)
+    else:
+        _geocode_bodies.move_to_end(key)
+    return _respond(request, encoded, geocode_max_age)
+
+
+def stats():
+    return {'requests': requests_served, 'not_modified': not_modified, 'forecast_bodies': len(_forecast_bodies),
+            'alert_watches': len(_alert_watches)}
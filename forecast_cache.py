@@ -0,0 +1,350 @@
+import collections
+import functools
+import inspect
+import os
+import pickle
+import threading
+import time
+import shared_store
+
+#Forecast cache that sits in front of the forecast providers. Locations are snapped to a grid so nearby users share
+#entries, each data type has its own time to live, memory is bounded with LRU eviction and an optional SQLite file
+#keeps entries across restarts.
+#Worker processes on one host can share that file. Each still serves from its own memory, but takes entries other
+#workers stored once its own copy expires, and leases in the file make sure only one worker at a time fetches a key.
+
+#Grid size in degrees. 0.05 is roughly 5 km, well below the resolution of the forecast models.
+grid_size = float(os.environ.get('FORECAST_CACHE_GRID', 0.05))
+#Seconds each data type stays fresh
+data_type_ttls = {'current': 10 * 60, 'hourly': 60 * 60, 'daily': 6 * 60 * 60}
+#Open-Meteo's current conditions, the stand-in for OpenWeather's, are as fresh as those
+data_type_ttls['current_open_meteo'] = data_type_ttls['current']
+#Once expired, an entry can still be served stale for this fraction of its TTL while it is revalidated
+stale_factor = 1.0
+max_entries = int(os.environ.get('FORECAST_CACHE_MAX_ENTRIES', 4096))
+#Path of the optional on-disk second tier, disabled when empty. Set it to the same file for every worker process.
+disk_path = os.environ.get('FORECAST_CACHE_DISK', '')
+#Seconds expired entries are kept on disk before they are purged. Past their stale window they are no longer served.
+disk_keep_seconds = 24 * 60 * 60
+
+
+#Snaps a coordinate to the centre of its grid cell
+def quantize(lat, lon, grid=None):
+    grid = grid or grid_size
+    return (round(round(lat / grid) * grid, 6), round(round(lon / grid) * grid, 6))
+
+
+class DiskTier():
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._connection = shared_store.connect(path)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS forecast_cache '
+                                 '(key TEXT PRIMARY KEY, expires REAL, value BLOB)')
+        self._connection.commit()
+        self.leases = shared_store.Leases(self._connection, self._lock)
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute('SELECT expires, value FROM forecast_cache WHERE key = ?',
+                                           (repr(key),)).fetchone()
+        if row is None:
+            return None
+        return (row[0], pickle.loads(row[1]))
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM forecast_cache').fetchone()[0]
+
+    def put(self, key, expires, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO forecast_cache VALUES (?, ?, ?)',
+                                     (repr(key), expires, blob))
+            self._connection.commit()
+
+    #Deletes the entries that expired before the given time, and leases that have run out
+    def purge_expired(self, before=None):
+        now = time.time()
+        with self._lock:
+            self._connection.execute('DELETE FROM forecast_cache WHERE expires < ?', (before or now,))
+            self._connection.commit()
+        self.leases.purge_expired(now)
+
+
+class ForecastCache():
+    def __init__(self, max_entries=max_entries, ttls=None, disk_path=''):
+        self.max_entries = max_entries
+        self.ttls = dict(ttls or data_type_ttls)
+        self.disk = DiskTier(disk_path) if disk_path else None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        #Entries taken from the disk tier after another worker stored them
+        self.peer_fills = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    #Keys are (data_type, lat, lon, units) with the location already quantized
+    @staticmethod
+    def key(data_type, lat, lon, units):
+        return (data_type, *quantize(lat, lon), units)
+
+    def _stale_until(self, key, expires):
+        return expires + self.ttls[key[0]] * stale_factor
+
+    #Returns (value, expires) for an entry that is fresh or still within its stale window, else (None, None).
+    #Older entries stay until they are evicted.
+    def lookup(self, key, now=None):
+        now = now or time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._stale_until(key, entry[0]) <= now:
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None and entry[0] <= now and self.disk is not None:
+            #Expired here, but another worker may have refreshed it already
+            entry = self._newer_on_disk(key, entry[0], now) or entry
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None and self._stale_until(key, entry[0]) > now:
+                self._store(key, entry)
+            else:
+                entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return (None, None)
+            if entry[0] > now:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+        return (entry[1], entry[0])
+
+    #Fresh value or None
+    def get(self, key, now=None):
+        now = now or time.time()
+        (value, expires) = self.lookup(key, now)
+        return value if value is not None and expires > now else None
+
+    #The value held for the key while it is fresh or within its stale window, else None. The fallback when every
+    #provider is failing or slow; unlike lookup it is not counted as a hit or miss.
+    def last_known(self, key, now=None):
+        now = now or time.time()
+        entry = self._entries.get(key)
+        if (entry is None or self._stale_until(key, entry[0]) <= now) and self.disk is not None:
+            entry = self.disk.get(key)
+        if entry is None or self._stale_until(key, entry[0]) <= now:
+            return None
+        return entry[1]
+
+    def expires(self, key):
+        entry = self._entries.get(key)
+        return None if entry is None else entry[0]
+
+    def put(self, key, value, now=None):
+        expires = (now or time.time()) + self.ttls[key[0]]
+        self._store(key, (expires, value))
+        if self.disk is not None:
+            self.disk.put(key, expires, value)
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    #The disk tier's entry for key, adopted into memory, when another worker stored one that is fresh and newer than
+    #expires. Else None.
+    def _newer_on_disk(self, key, expires, now=None):
+        entry = self.disk.get(key)
+        if entry is None or entry[0] <= max(expires, now or time.time()):
+            return None
+        self._store(key, entry)
+        with self._lock:
+            self.peer_fills += 1
+        return entry
+
+    #Cross-process single flight, for workers sharing a disk tier. Returns (True, None) when this worker should fetch
+    #the key, holding its lease until release(), or (False, value) with a value another worker has stored since this
+    #one's copy. With wait, a key another worker is fetching is waited for, else it gives (False, None).
+    #Without a disk tier every key is claimed.
+    def claim(self, key, wait=True):
+        if self.disk is None:
+            return (True, None)
+        known = self.expires(key) or 0
+        lease = repr(key)
+        if self.disk.leases.acquire(lease):
+            entry = self._newer_on_disk(key, known)
+            if entry is None:
+                return (True, None)
+            self.disk.leases.release(lease)
+            return (False, entry[1])
+        if not wait:
+            return (False, None)
+        entry = self.disk.leases.wait(lease, lambda: self._newer_on_disk(key, known))
+        if entry is None:
+            #The other worker failed or died, so this one fetches, without waiting for the lease to expire
+            return (True, None)
+        return (False, entry[1])
+
+    def release(self, key):
+        if self.disk is not None:
+            self.disk.leases.release(repr(key))
+
+    #Drops disk entries that expired more than disk_keep_seconds ago. Returns the number of entries left on disk.
+    def purge_disk(self, now=None):
+        if self.disk is None:
+            return 0
+        self.disk.purge_expired((now or time.time()) - disk_keep_seconds)
+        return len(self.disk)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        stats = {'entries': len(self._entries), 'hits': self.hits, 'stale_hits': self.stale_hits,
+                 'misses': self.misses}
+        if self.disk is not None:
+            stats.update(peer_fills=self.peer_fills, leases=self.disk.leases.stats())
+        return stats
+
+
+default_cache = ForecastCache(disk_path=disk_path)
+
+
+#data_type -> (uncached provider function, upstream provider name), filled in by the cached decorator
+providers = {}
+#data_type -> function fetching many locations in one call, filled in by the batched decorator
+batch_providers = {}
+#Called with the key of every lookup, e.g. to track which locations are popular
+access_listeners = []
+#Called with the key of every stale entry that was served. With no listener, stale entries are refetched inline.
+stale_listeners = []
+#Called with the key and 'hit', 'stale' or 'miss' for every lookup
+lookup_listeners = []
+#Called with (provider, seconds, error) after every upstream fetch, error being None when it succeeded.
+#May be called from worker threads.
+fetch_listeners = []
+
+
+#Calls an upstream provider function, reporting its latency and outcome to the fetch listeners
+def timed_call(provider, func, *args):
+    start = time.perf_counter()
+    try:
+        value = func(*args)
+    except Exception as e:
+        for listener in fetch_listeners:
+            listener(provider, time.perf_counter() - start, e)
+        raise
+    for listener in fetch_listeners:
+        listener(provider, time.perf_counter() - start, None)
+    return value
+
+
+#Fetches the data for a key from its provider and stores it, regardless of what is cached. Workers sharing a disk
+#tier take each other's fetches instead of repeating them.
+def refresh(key, cache=None):
+    target = cache or default_cache
+    (func, provider) = providers[key[0]]
+    (claimed, value) = target.claim(key)
+    if not claimed:
+        return value
+    try:
+        value = timed_call(provider, func, key[1], key[2], key[3])
+        target.put(key, value)
+    finally:
+        target.release(key)
+    return value
+
+
+#Refreshes many keys at once. Data types with a batch provider are fetched with one call per units, the rest one
+#key at a time. Batched keys another worker is already fetching are left to it.
+def refresh_many(keys, cache=None):
+    target = cache or default_cache
+    groups = {}
+    for key in keys:
+        groups.setdefault((key[0], key[3]), []).append(key)
+    for ((data_type, units), group) in groups.items():
+        if data_type in batch_providers:
+            claimed = [key for key in group if target.claim(key, wait=False)[0]]
+            if not claimed:
+                continue
+            try:
+                values = timed_call(providers[data_type][1], batch_providers[data_type],
+                                    [(key[1], key[2]) for key in claimed], units)
+                for (key, value) in zip(claimed, values):
+                    target.put(key, value)
+            finally:
+                for key in claimed:
+                    target.release(key)
+        else:
+            for key in group:
+                refresh(key, target)
+
+
+#Fills the cache for a list of (lat, lon) locations, e.g. at startup. Returns the number of grid cells fetched.
+def warm(data_type, coordinates, units, cache=None):
+    target = cache or default_cache
+    keys = list(dict.fromkeys(target.key(data_type, lat, lon, units) for (lat, lon) in coordinates))
+    refresh_many(keys, target)
+    return len(keys)
+
+
+#Decorator registering a function that takes a list of (lat, lon) and units and returns one value per location,
+#in the same shape as the cached provider of that data type
+def batched(data_type):
+    def decorator(func):
+        batch_providers[data_type] = func
+        return func
+    return decorator
+
+
+#Cached value for a key as a provider call would serve it, or None where it would have to fetch. Never fetches, so it
+#is safe on the event loop; stale entries are reported to the stale listeners like any other stale hit.
+def peek(key, cache=None):
+    target = cache or default_cache
+    now = time.time()
+    (value, expires) = target.lookup(key, now)
+    for listener in access_listeners:
+        listener(key)
+    if value is not None and (expires > now or stale_listeners):
+        if expires <= now:
+            for listener in stale_listeners:
+                listener(key)
+        for listener in lookup_listeners:
+            listener(key, 'hit' if expires > now else 'stale')
+        return value
+    for listener in lookup_listeners:
+        listener(key, 'miss')
+    return None
+
+
+#Decorator for provider functions with a (lat, lon, units) signature, where units may have a default. The upstream
+#call is made for the centre of the grid cell so an entry holds the same data no matter which nearby user caused it
+#to be fetched. provider names the upstream service, for rate budgets.
+def cached(data_type, provider='', cache=None):
+    def decorator(func):
+        signature = inspect.signature(func)
+        providers[data_type] = (func, provider)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            target = cache or default_cache
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            (lat, lon, units) = list(bound.arguments.values())[:3]
+            key = target.key(data_type, lat, lon, units)
+            value = peek(key, target)
+            if value is not None:
+                return value
+            return refresh(key, target)
+        wrapper.data_type = data_type
+        wrapper.uncached = func
+        return wrapper
+    return decorator
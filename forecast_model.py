@@ -0,0 +1,175 @@
+import math
+import struct
+import numpy as np
+import units
+
+#Compact forecast model shared by the provider adapters. Series hold int64 epoch seconds and float32 values in NumPy
+#arrays, missing values are NaN, and each series packs into a single bytes blob, which is what the forecast cache's
+#disk tier stores when it pickles one.
+
+
+#Base for the series classes. columns lists (attribute, dtype); every column has one value per time.
+class ForecastSeries():
+    __slots__ = ('utc_offset', '__weakref__')
+    columns = ()
+    #Columns converted when a series is exported in another temperature scale
+    temperature_columns = ()
+    _header = struct.Struct('<Ii')
+
+    def __init__(self, utc_offset=0, **values):
+        self.utc_offset = utc_offset
+        for (name, dtype) in self.columns:
+            setattr(self, name, np.asarray(values[name], dtype=dtype))
+
+    def __len__(self):
+        return len(self.times)
+
+    def to_bytes(self):
+        return self._header.pack(len(self), self.utc_offset) + b''.join(
+            np.ascontiguousarray(getattr(self, name)).tobytes() for (name, dtype) in self.columns)
+
+    @classmethod
+    def from_bytes(cls, data):
+        (length, utc_offset) = cls._header.unpack_from(data)
+        offset = cls._header.size
+        values = {}
+        for (name, dtype) in cls.columns:
+            values[name] = np.frombuffer(data, dtype=dtype, count=length, offset=offset)
+            offset += values[name].nbytes
+        return cls(utc_offset, **values)
+
+    def __reduce__(self):
+        return (type(self).from_bytes, (self.to_bytes(),))
+
+    #JSON-ready {'utc_offset': int, column: list}, with temperatures in the given scale and missing values as None
+    def to_dict(self, scale=units.canonical_scale):
+        values = {'utc_offset': int(self.utc_offset)}
+        for (name, dtype) in self.columns:
+            column = getattr(self, name)
+            if name in self.temperature_columns:
+                column = units.convert_temperature(column.astype(np.float64), scale)
+            values[name] = _json_column(column)
+        return values
+
+
+def _json_column(column):
+    if column.dtype.kind == 'S':
+        return [value.decode() for value in column.tolist()]
+    if column.dtype.kind == 'f':
+        return np.where(np.isnan(column), None, np.round(column.astype(np.float64), 2)).tolist()
+    return column.tolist()
+
+
+def _json_number(value):
+    return None if value is None or math.isnan(value) else round(float(value), 2)
+
+
+def _json_temperature(celsius, scale):
+    return None if celsius is None else _json_number(units.convert_temperature(float(celsius), scale))
+
+
+class HourlyForecast(ForecastSeries):
+    __slots__ = ('times', 'temperature', 'feels_like', 'humidity', 'precipitation_chance', 'icon')
+    columns = (('times', np.int64), ('temperature', np.float32), ('feels_like', np.float32),
+               ('humidity', np.float32), ('precipitation_chance', np.float32), ('icon', 'S3'))
+    temperature_columns = ('temperature', 'feels_like')
+
+
+class DailyForecast(ForecastSeries):
+    __slots__ = ('times', 'max_temperature', 'min_temperature', 'max_feels_like', 'min_feels_like',
+                 'precipitation_chance', 'weather_code')
+    columns = (('times', np.int64), ('max_temperature', np.float32), ('min_temperature', np.float32),
+               ('max_feels_like', np.float32), ('min_feels_like', np.float32),
+               ('precipitation_chance', np.float32), ('weather_code', np.int16))
+    temperature_columns = ('max_temperature', 'min_temperature', 'max_feels_like', 'min_feels_like')
+
+
+class CurrentConditions():
+    __slots__ = ('time', 'utc_offset', 'temperature', 'feels_like', 'humidity', 'rain', 'icon', '__weakref__')
+
+    def __init__(self, time, utc_offset, temperature, feels_like, humidity, rain, icon):
+        self.time = time
+        self.utc_offset = utc_offset
+        self.temperature = temperature
+        self.feels_like = feels_like
+        self.humidity = humidity
+        #Rain in the last hour in mm
+        self.rain = rain
+        self.icon = icon
+
+    def to_dict(self, scale=units.canonical_scale):
+        return {'time': int(self.time), 'utc_offset': int(self.utc_offset),
+                'temperature': _json_temperature(self.temperature, scale),
+                'feels_like': _json_temperature(self.feels_like, scale),
+                'humidity': _json_number(self.humidity), 'rain': _json_number(self.rain), 'icon': self.icon}
+
+
+#Adapters from the provider payloads. When one provider stands in for the other, weather codes and icons are
+#translated through these two tables.
+
+#WMO weather code -> OpenWeather icon, without the day/night letter
+open_weather_icons_by_weather_code = {
+    0: '01', 1: '02', 2: '03', 3: '04', 45: '50', 48: '50', 51: '09', 53: '09', 55: '09', 56: '09', 57: '09',
+    61: '10', 63: '10', 65: '10', 66: '13', 67: '13', 71: '13', 73: '13', 75: '13', 77: '13', 80: '09', 81: '09',
+    82: '09', 85: '13', 86: '13', 95: '11', 96: '11', 99: '11',
+}
+#OpenWeather icon without the day/night letter -> WMO weather code
+weather_codes_by_open_weather_icon = {
+    '01': 0, '02': 1, '03': 2, '04': 3, '09': 80, '10': 61, '11': 95, '13': 71, '50': 45,
+}
+
+def hourly_from_open_weather(payload):
+    entries = payload['list']
+    return HourlyForecast(
+        utc_offset=payload['city']['timezone'],
+        times=[entry['dt'] for entry in entries],
+        temperature=[entry['main'].get('temp', math.nan) for entry in entries],
+        feels_like=[entry['main'].get('feels_like', math.nan) for entry in entries],
+        humidity=[entry['main'].get('humidity', math.nan) for entry in entries],
+        precipitation_chance=[entry['pop'] * 100 if 'pop' in entry else math.nan for entry in entries],
+        icon=[entry['weather'][0]['icon'] for entry in entries])
+
+
+def current_from_open_weather(payload):
+    return CurrentConditions(
+        time=payload.get('dt', 0),
+        utc_offset=payload.get('timezone', 0),
+        temperature=payload['main'].get('temp'),
+        feels_like=payload['main'].get('feels_like'),
+        humidity=payload['main'].get('humidity'),
+        rain=float(payload.get('rain', {}).get('1h', 0)),
+        icon=payload['weather'][0]['icon'])
+
+
+#Current conditions from an Open-Meteo response requested with get_weather.openmeteo_current_variables
+def current_from_open_meteo(response):
+    current = response.Current()
+    (temperature, humidity, feels_like, rain, weather_code, is_day) = [
+        current.Variables(i).Value() for i in range(current.VariablesLength())]
+    icon = open_weather_icons_by_weather_code.get(int(weather_code), '01') + ('d' if is_day else 'n')
+    return CurrentConditions(time=current.Time(), utc_offset=response.UtcOffsetSeconds(), temperature=temperature,
+                             feels_like=feels_like, humidity=humidity, rain=rain, icon=icon)
+
+
+#Daily summary of an hourly forecast, grouped by local day. The most severe weather of the day picks its code.
+def daily_from_hourly(hourly):
+    local_days = (hourly.times + hourly.utc_offset) // (24 * 60 * 60)
+    (days, starts) = np.unique(local_days, return_index=True)
+    codes = np.array([weather_codes_by_open_weather_icon.get(icon[:2].decode(), 0) for icon in hourly.icon],
+                     dtype=np.int16)
+    with np.errstate(all='ignore'):
+        return DailyForecast(
+            utc_offset=hourly.utc_offset,
+            times=days * 24 * 60 * 60 - hourly.utc_offset,
+            max_temperature=np.fmax.reduceat(hourly.temperature, starts),
+            min_temperature=np.fmin.reduceat(hourly.temperature, starts),
+            max_feels_like=np.fmax.reduceat(hourly.feels_like, starts),
+            min_feels_like=np.fmin.reduceat(hourly.feels_like, starts),
+            precipitation_chance=np.fmax.reduceat(hourly.precipitation_chance, starts),
+            weather_code=np.maximum.reduceat(codes, starts))
+
+
+#Row index of a columnar get_weather.get_openmeteo_weather_batch result
+def daily_from_open_meteo(batch, index):
+    return DailyForecast(utc_offset=int(batch['UTC Offset'][index]), times=batch['Dates'][index].copy(),
+                         **{name: values[index].copy() for (name, values) in batch['Daily'].items()})
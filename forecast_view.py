@@ -0,0 +1,142 @@
+import datetime
+import functools
+import weakref
+import numpy as np
+import get_weather
+import mapping
+import units
+
+#Display rows for the hourly table and the seven-day cards, built column by column from the forecast_model arrays.
+#Times are shifted to local time in one step and every distinct day, time of day, rounded value and icon is formatted
+#once. The finished rows are kept per forecast object and scale, so every client showing the same cached forecast
+#shares one payload. Rows are shared; treat them as read only.
+
+seconds_per_day = 24 * 60 * 60
+
+#forecast object -> {(scale, utc_offset): rows}, dropped together with the forecast when it leaves the cache
+_hourly_rows = weakref.WeakKeyDictionary()
+_daily_cards = weakref.WeakKeyDictionary()
+
+
+@functools.lru_cache(maxsize=4096)
+def _day_label(local_day, format):
+    return (datetime.datetime(1970, 1, 1) + datetime.timedelta(days=local_day)).strftime(format)
+
+
+@functools.lru_cache(maxsize=24 * 60)
+def _time_label(local_seconds):
+    return (datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=local_seconds)).strftime('%I:%M%p')
+
+
+@functools.lru_cache(maxsize=4096)
+def _rounded_label(value, suffix):
+    return f'{value}{suffix}'
+
+
+@functools.lru_cache(maxsize=256)
+def _open_weather_icon_url(icon):
+    return f'https://openweathermap.org/img/wn/{icon.decode()}.png'
+
+
+@functools.lru_cache(maxsize=256)
+def _weather_code_icon(code):
+    return f'img:weather_icons/{get_weather.weather_code_icon_dict[code]}.svg'
+
+
+#Applies formatter once per distinct value and spreads the results back out to every position
+def _labels(values, formatter, *args):
+    (distinct, inverse) = np.unique(values, return_inverse=True)
+    labels = np.array([formatter(value, *args) for value in distinct.tolist()], dtype=object)
+    return labels[inverse.reshape(-1)]
+
+
+#Rounded labels with a suffix, e.g. [21.6, nan] -> ['22°', 'NaN'], rounding halves to even like round()
+def rounded_labels(values, suffix, default='NaN'):
+    missing = np.isnan(values)
+    rounded = np.rint(np.where(missing, 0, values)).astype(np.int64)
+    labels = _labels(rounded, _rounded_label, suffix)
+    labels[missing] = default
+    return labels.tolist()
+
+
+def temperature_labels(celsius, scale):
+    return rounded_labels(units.convert_temperature(celsius.astype(np.float64), scale),
+                          units.temperature_suffixes[scale])
+
+
+def day_labels(times, utc_offset, format='%a %b %d'):
+    return _labels((times + utc_offset) // seconds_per_day, _day_label, format).tolist()
+
+
+def time_labels(times, utc_offset):
+    return _labels((times + utc_offset) % seconds_per_day, _time_label).tolist()
+
+
+def _build_hourly_rows(hourly, scale, utc_offset):
+    columns = zip(day_labels(hourly.times, utc_offset),
+                  time_labels(hourly.times, utc_offset),
+                  temperature_labels(hourly.temperature, scale),
+                  temperature_labels(hourly.feels_like, scale),
+                  rounded_labels(hourly.precipitation_chance, '%'),
+                  _labels(hourly.icon, _open_weather_icon_url).tolist(),
+                  rounded_labels(hourly.humidity, '%'))
+    return [{'id': i, 'day': day, 'time': time, 'temperature': temperature, 'feels_like': feels_like,
+             'precipitation': precipitation, 'weather_icon': weather_icon, 'humidity': humidity}
+            for (i, (day, time, temperature, feels_like, precipitation, weather_icon, humidity)) in enumerate(columns)]
+
+
+def _build_daily_cards(daily, scale, utc_offset):
+    columns = zip(day_labels(daily.times, utc_offset, '%a %m/%d'),
+                  temperature_labels(daily.max_temperature, scale),
+                  temperature_labels(daily.min_temperature, scale),
+                  rounded_labels(daily.precipitation_chance, '%'),
+                  _labels(daily.weather_code, _weather_code_icon).tolist())
+    return [{'date': date, 'high': high, 'low': low, 'precipitation': precipitation, 'icon': icon}
+            for (date, high, low, precipitation, icon) in columns]
+
+
+def _shared(payloads, forecast, build, scale, utc_offset):
+    by_view = payloads.get(forecast)
+    if by_view is None:
+        by_view = payloads[forecast] = {}
+    view = (scale, utc_offset)
+    if view not in by_view:
+        by_view[view] = build(forecast, scale, utc_offset)
+    return by_view[view]
+
+
+#Rows for the hourly table, in the forecast's own time zone unless utc_offset is given
+def hourly_rows(hourly, scale, utc_offset=None):
+    return _shared(_hourly_rows, hourly, _build_hourly_rows, scale,
+                   hourly.utc_offset if utc_offset is None else utc_offset)
+
+
+#Keyword arguments for each DailyWeather card
+def daily_cards(daily, scale, utc_offset=None):
+    return _shared(_daily_cards, daily, _build_daily_cards, scale,
+                   daily.utc_offset if utc_offset is None else utc_offset)
+
+
+#Everything the page shows for a forecast, formatted for one scale, plus the forecasts it was built from so a page
+#started from it can re-render in another scale
+def page_view(name, lat, lon, current, hourly, daily, scale):
+    page = {
+        'name': name,
+        'lat': lat,
+        'lon': lon,
+        'scale': scale,
+        'current': current,
+        'hourly': hourly,
+        'daily': daily,
+        'location': f'{name} ({round(lat, 2)}' + u"\N{DEGREE SIGN}N" + f', {round(lon, 2)}' + u"\N{DEGREE SIGN}E)",
+        'today_location': name,
+        'today_image': f'https://openweathermap.org/img/wn/{current.icon}@2x.png',
+        'today_temp': units.format_temperature(current.temperature, scale),
+        'today_humidity': units.format_percent(current.humidity),
+        'today_feels_like': units.format_temperature(current.feels_like, scale),
+        'today_precipitation': f'{current.rain:g} mm',
+        'hourly_rows': hourly_rows(hourly, scale),
+        'daily_cards': daily_cards(daily, scale, hourly.utc_offset),
+        'map_centre': mapping.snap_to_tile_centre(lat, lon),
+    }
+    return page
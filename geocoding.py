@@ -0,0 +1,326 @@
+import array
+import bisect
+import collections
+import csv
+import math
+import os
+import re
+import threading
+import get_weather
+import shared_store
+
+#Geocoding with as few trips to the OpenWeather geocoder as possible. Lookups go through, in order:
+#   1. a persistent cache of normalized query -> (name, lat, lon)
+#   2. an optional local gazetteer of US places and ZIP centroids loaded from a CSV
+#   3. the OpenWeather geocoder, whose answer is then cached
+#Reverse lookups use the gazetteer's spatial buckets for the nearest place, then a cache of earlier remote answers.
+
+cache_path = os.environ.get('GEOCODE_CACHE', '.geocode_cache.sqlite')
+#Searches remembered, in memory and in the file. Anyone can search, so this keeps both from growing without limit.
+cache_max_entries = int(os.environ.get('GEOCODE_CACHE_MAX_ENTRIES', 10000))
+#CSV with name,state,zip,lat,lon columns; zip may be empty for places and name may be the city for ZIP rows
+gazetteer_path = os.environ.get('GAZETTEER_CSV', '')
+#A reverse lookup only uses a gazetteer place within this many km
+reverse_max_distance_km = 15
+#Reverse answers from the remote geocoder are reused within cells of this many degrees
+reverse_cache_grid = 0.01
+
+state_abbreviations = {
+    'alabama': 'al', 'alaska': 'ak', 'arizona': 'az', 'arkansas': 'ar', 'california': 'ca', 'colorado': 'co',
+    'connecticut': 'ct', 'delaware': 'de', 'district of columbia': 'dc', 'florida': 'fl', 'georgia': 'ga',
+    'hawaii': 'hi', 'idaho': 'id', 'illinois': 'il', 'indiana': 'in', 'iowa': 'ia', 'kansas': 'ks',
+    'kentucky': 'ky', 'louisiana': 'la', 'maine': 'me', 'maryland': 'md', 'massachusetts': 'ma', 'michigan': 'mi',
+    'minnesota': 'mn', 'mississippi': 'ms', 'missouri': 'mo', 'montana': 'mt', 'nebraska': 'ne', 'nevada': 'nv',
+    'new hampshire': 'nh', 'new jersey': 'nj', 'new mexico': 'nm', 'new york': 'ny', 'north carolina': 'nc',
+    'north dakota': 'nd', 'ohio': 'oh', 'oklahoma': 'ok', 'oregon': 'or', 'pennsylvania': 'pa',
+    'rhode island': 'ri', 'south carolina': 'sc', 'south dakota': 'sd', 'tennessee': 'tn', 'texas': 'tx',
+    'utah': 'ut', 'vermont': 'vt', 'virginia': 'va', 'washington': 'wa', 'west virginia': 'wv',
+    'wisconsin': 'wi', 'wyoming': 'wy', 'puerto rico': 'pr',
+}
+#Longest names first so 'west virginia' is not read as 'virginia'
+_state_name_pattern = re.compile(r'\b(' + '|'.join(sorted(state_abbreviations, key=len, reverse=True)) + r')\b')
+_country_suffix_pattern = re.compile(r'\s+(usa|us|united states( of america)?)$')
+
+
+#Lower case, punctuation removed, states abbreviated and a trailing US country dropped,
+#e.g. 'Springfield, Illinois, USA' -> 'springfield il'
+def normalize_query(text):
+    text = re.sub(r'[^\w\s]', ' ', text.lower())
+    text = re.sub(r'\s+', ' ', text).strip()
+    text = _country_suffix_pattern.sub('', text)
+    return _state_name_pattern.sub(lambda match: state_abbreviations[match.group(1)], text)
+
+
+def query_from_parts(location_string='', place_name='', state_name='', country_name='', zip_code=''):
+    return normalize_query(' '.join([location_string, place_name, state_name, country_name, zip_code]))
+
+
+#Same tagging update_weather used to do, for queries that have to go to the remote geocoder
+def tag_location(location_string='', place_name='', state_name='', country_name='', zip_code=''):
+    import usaddress
+    (tagged_location, location_type) = usaddress.tag(location_string)
+    if place_name:
+        tagged_location['PlaceName'] = place_name
+    if state_name:
+        tagged_location['StateName'] = state_name
+    if country_name:
+        tagged_location['CountryName'] = country_name
+    if zip_code:
+        tagged_location['ZipCode'] = zip_code
+    return tagged_location
+
+
+def _distance_km(lat1, lon1, lat2, lon2):
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371 * math.hypot(x, y)
+
+
+#Least recently used searches are dropped from memory past max_entries. The file keeps the max_entries most recently
+#added ones, in rowid order as INSERT OR REPLACE gives a replaced row a new rowid.
+class GeocodeCache():
+    def __init__(self, path, max_entries=cache_max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._connection = None
+        if path:
+            self._connection = shared_store.connect(path)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS geocode_cache '
+                                     '(query TEXT PRIMARY KEY, name TEXT, lat REAL, lon REAL)')
+            self._connection.commit()
+            rows = self._connection.execute('SELECT query, name, lat, lon FROM geocode_cache ORDER BY rowid DESC '
+                                            'LIMIT ?', (max_entries,)).fetchall()
+            for (query, name, lat, lon) in reversed(rows):
+                self._entries[query] = {'name': name, 'lat': lat, 'lon': lon}
+
+    def _remember(self, query, entry):
+        self._entries[query] = entry
+        self._entries.move_to_end(query)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    #Queries not in memory are looked up in the file too, where other worker processes may have put them
+    def get(self, query):
+        with self._lock:
+            entry = self._entries.get(query)
+            if entry is not None:
+                self._entries.move_to_end(query)
+                return entry
+            if self._connection is None:
+                return None
+            row = self._connection.execute('SELECT name, lat, lon FROM geocode_cache WHERE query = ?',
+                                           (query,)).fetchone()
+            if row is None:
+                return None
+            entry = {'name': row[0], 'lat': row[1], 'lon': row[2]}
+            self._remember(query, entry)
+        return entry
+
+    def put(self, query, result):
+        entry = {'name': result['name'], 'lat': result['lat'], 'lon': result['lon']}
+        with self._lock:
+            self._remember(query, entry)
+            if self._connection is not None:
+                self._connection.execute('INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?, ?)',
+                                         (query, entry['name'], entry['lat'], entry['lon']))
+                self._connection.execute('DELETE FROM geocode_cache WHERE rowid <= (SELECT rowid FROM geocode_cache '
+                                         'ORDER BY rowid DESC LIMIT 1 OFFSET ?)', (self.max_entries,))
+                self._connection.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+#Compact in-memory index of US places. Coordinates live in flat arrays and every place is
+#reachable by its normalized 'name st' key and, for ZIP rows, by its ZIP code. For prefix search places are also
+#listed under 'st name', so typing a state abbreviation suggests places in that state.
+class Gazetteer():
+    bucket_size = 0.5
+
+    def __init__(self):
+        self.names = []
+        self.states = []
+        self.lats = array.array('d')
+        self.lons = array.array('d')
+        self.exact = {}
+        self._prefix_entries = []
+        self.keys = []
+        self.key_places = array.array('l')
+        self.buckets = {}
+
+    @classmethod
+    def from_csv(cls, path):
+        gazetteer = cls()
+        with open(path, newline='', encoding='utf-8') as csv_file:
+            for row in csv.DictReader(csv_file):
+                gazetteer.add(row['name'], row.get('state', ''), row.get('zip', ''), float(row['lat']), float(row['lon']))
+        gazetteer.build()
+        return gazetteer
+
+    def add(self, name, state, zip_code, lat, lon):
+        index = len(self.names)
+        self.names.append(name)
+        self.states.append(state.upper())
+        self.lats.append(lat)
+        self.lons.append(lon)
+        for key in (normalize_query(f'{name} {state}'), zip_code.strip()):
+            if key and key not in self.exact:
+                self.exact[key] = index
+                self._prefix_entries.append((key, index))
+        if state:
+            self._prefix_entries.append((normalize_query(f'{state} {name}'), index))
+        self.buckets.setdefault(self._bucket(lat, lon), []).append(index)
+
+    #Sorts the keys once loading is done so prefix lookups are a binary search
+    def build(self):
+        ordered = sorted(self._prefix_entries)
+        self._prefix_entries = []
+        self.keys = [key for (key, index) in ordered]
+        self.key_places = array.array('l', [index for (key, index) in ordered])
+
+    def _bucket(self, lat, lon):
+        return (math.floor(lat / self.bucket_size), math.floor(lon / self.bucket_size))
+
+    def place(self, index):
+        name = f'{self.names[index]}, {self.states[index]}' if self.states[index] else self.names[index]
+        return {'name': name, 'lat': self.lats[index], 'lon': self.lons[index]}
+
+    def lookup(self, query):
+        index = self.exact.get(query)
+        return None if index is None else self.place(index)
+
+    #Places whose key starts with the given normalized prefix, in key order
+    def prefix(self, query, limit=10):
+        results = []
+        seen = set()
+        start = bisect.bisect_left(self.keys, query)
+        for position in range(start, len(self.keys)):
+            if not self.keys[position].startswith(query) or len(results) >= limit:
+                break
+            index = self.key_places[position]
+            if index not in seen:
+                seen.add(index)
+                results.append((self.keys[position], self.place(index)))
+        return results
+
+    #Nearest place within max_distance_km, searching rings of buckets outward from the point
+    def nearest(self, lat, lon, max_distance_km=reverse_max_distance_km):
+        (bucket_lat, bucket_lon) = self._bucket(lat, lon)
+        max_ring = int(max_distance_km / (111 * self.bucket_size * max(math.cos(math.radians(lat)), 0.1))) + 1
+        best = None
+        for ring in range(max_ring + 1):
+            for i in range(bucket_lat - ring, bucket_lat + ring + 1):
+                for j in range(bucket_lon - ring, bucket_lon + ring + 1):
+                    if max(abs(i - bucket_lat), abs(j - bucket_lon)) != ring:
+                        continue
+                    for index in self.buckets.get((i, j), ()):
+                        distance = _distance_km(lat, lon, self.lats[index], self.lons[index])
+                        if distance <= max_distance_km and (best is None or distance < best[0]):
+                            best = (distance, index)
+            #Anything in a further ring is at least a bucket away, so stop once a close enough match is found
+            if best is not None and best[0] <= ring * 111 * self.bucket_size * math.cos(math.radians(lat)):
+                break
+        return None if best is None else self.place(best[1])
+
+    def __len__(self):
+        return len(self.names)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+gazetteer = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = GeocodeCache(cache_path)
+    return _cache
+
+
+def load_gazetteer(path):
+    global gazetteer
+    gazetteer = Gazetteer.from_csv(path)
+    print(f'Loaded {len(gazetteer)} gazetteer places from {path}')
+    return gazetteer
+
+
+#Opens the persistent cache and loads the gazetteer configured through GAZETTEER_CSV, if any
+def init():
+    get_cache()
+    if gazetteer_path and gazetteer is None:
+        load_gazetteer(gazetteer_path)
+
+
+#Local answer for a normalized query, or None if the remote geocoder is needed
+def lookup(query):
+    result = get_cache().get(query)
+    if result is None and gazetteer is not None:
+        result = gazetteer.lookup(query)
+    return result
+
+
+#Type-ahead suggestions for partially typed text from the gazetteer prefix index. A partly typed state name at the
+#end, e.g. 'springfield illin', is also tried as its abbreviation.
+def suggest(text, limit=8):
+    query = normalize_query(text)
+    if gazetteer is None or not query:
+        return []
+    queries = [query]
+    (rest, _, last_word) = query.rpartition(' ')
+    if rest and len(last_word) >= 3:
+        queries += [f'{rest} {abbreviation}' for (state, abbreviation) in state_abbreviations.items()
+                    if state.startswith(last_word)]
+    suggestions = []
+    names = set()
+    for prefix_query in queries:
+        for (key, place) in gazetteer.prefix(prefix_query, limit):
+            if place['name'] not in names and len(suggestions) < limit:
+                names.add(place['name'])
+                suggestions.append(place)
+    return suggestions
+
+
+def remember(query, result):
+    get_cache().put(query, result)
+
+
+def _reverse_query(lat, lon):
+    return 'reverse:%.2f,%.2f' % (round(lat / reverse_cache_grid) * reverse_cache_grid,
+                                  round(lon / reverse_cache_grid) * reverse_cache_grid)
+
+
+#Local answer for a point, or None if the remote reverse geocoder is needed
+def reverse_lookup(lat, lon):
+    if gazetteer is not None:
+        result = gazetteer.nearest(lat, lon)
+        if result is not None:
+            return result
+    return get_cache().get(_reverse_query(lat, lon))
+
+
+def remember_reverse(lat, lon, result):
+    get_cache().put(_reverse_query(lat, lon), result)
+
+
+#Blocking geocode of a search, going to OpenWeather only when neither the cache nor the gazetteer knows it.
+#Raises ValueError when the location cannot be found.
+def geocode(location_string='', place_name='', state_name='', country_name='', zip_code=''):
+    query = query_from_parts(location_string, place_name, state_name, country_name, zip_code)
+    result = lookup(query)
+    if result is None:
+        tagged_location = tag_location(location_string, place_name, state_name, country_name, zip_code)
+        result = get_weather.get_open_weather_geocode(tagged_location)
+        remember(query, result)
+    return result
+
+
+def reverse_geocode(lat, lon):
+    result = reverse_lookup(lat, lon)
+    if result is None:
+        result = get_weather.get_open_weather_reverse_geocode(lat, lon)
+        remember_reverse(lat, lon, result)
+    return result
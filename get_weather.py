@@ -1,29 +1,48 @@
-import requests
-import requests_cache
-from retry_requests import retry
-import openmeteo_requests
+import http_sessions
+import forecast_cache
+import metrics
+import forecast_model
 import os
 import math
-import pandas as pd
+import numpy as np
 
-open_weather_api_key = os.environ['OPEN_WEATHER_API_KEY']
 open_weather_units = {'F': 'imperial', 'C': 'metric', 'K': 'standard'}
 open_meteo_units =  {'F': 'fahrenheit', 'C': 'celsius'}
+#Upstream base URLs, overridable so load tests can point the app at local stand-ins, see benchmarks/stub_upstreams.py
+open_weather_url = os.environ.get('OPEN_WEATHER_URL', 'https://api.openweathermap.org')
+open_weather_tile_url = os.environ.get('OPEN_WEATHER_TILE_URL', 'https://tile.openweathermap.org')
+open_meteo_url = os.environ.get('OPEN_METEO_URL', 'https://api.open-meteo.com')
+weather_gov_url = os.environ.get('WEATHER_GOV_URL', 'https://api.weather.gov')
+ipify_url = os.environ.get('IPIFY_URL', 'https://api64.ipify.org')
+ipapi_url = os.environ.get('IPAPI_URL', 'https://ipapi.co')
 
 
+#The API key is read on first use rather than at import, so importing the app, e.g. to time startup, does not need it
+def get_open_weather_api_key():
+    return os.environ['OPEN_WEATHER_API_KEY']
+
+
+#Keeps get_weather.open_weather_api_key working for code that still reads it as a module attribute
+def __getattr__(name):
+    if name == 'open_weather_api_key':
+        return get_open_weather_api_key()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+@metrics.traced
 def get_open_weather_geocode(tagged_location):
     if 'ZipCode' in tagged_location:
-        result = requests.get('http://api.openweathermap.org/geo/1.0/zip', {
+        result = http_sessions.get_session('open_weather').get(f'{open_weather_url}/geo/1.0/zip', {
             'zip': f'{tagged_location["ZipCode"]},{"US"}',
-            'appid': open_weather_api_key,
+            'appid': get_open_weather_api_key(),
             'limit': 1
         }, timeout=3)
         result.raise_for_status()
         return result.json()
     elif 'PlaceName' in tagged_location:
-        result = requests.get('http://api.openweathermap.org/geo/1.0/direct', {
+        result = http_sessions.get_session('open_weather').get(f'{open_weather_url}/geo/1.0/direct', {
             'q': f'{tagged_location["PlaceName"]},{tagged_location.get("StateName", "")},{tagged_location.get("CountryName", "US")}',
-            'appid': open_weather_api_key,
+            'appid': get_open_weather_api_key(),
             'limit': 1
         }, timeout=3)
         result.raise_for_status()
@@ -35,42 +54,47 @@ def get_open_weather_geocode(tagged_location):
       raise ValueError('Missing required fields in tagged_location')
 
 
+@metrics.traced
 def get_open_weather_reverse_geocode(lat, lon):
     print(lat, lon)
-    result = requests.get('http://api.openweathermap.org/geo/1.0/reverse', {
+    result = http_sessions.get_session('open_weather').get(f'{open_weather_url}/geo/1.0/reverse', {
         'lat': lat,
         'lon': lon,
-        'appid': open_weather_api_key,
+        'appid': get_open_weather_api_key(),
         'limit': 1
     }, timeout=3)
     return result.json()[0]
 
-#Units can be 'imperial', 'metric', or 'standard' (i.e. Kelvin)
+#Units can be 'imperial', 'metric', or 'standard' (i.e. Kelvin). Returns a forecast_model.HourlyForecast
+@forecast_cache.cached('hourly', 'open_weather')
+@metrics.traced
 def get_open_weather_five_day_forcast(lat, lon, units='imperial'):
     if units not in ['imperial', 'metric', 'standard']:
         raise ValueError("Unknown Units Type")
-    result = requests.get('https://api.openweathermap.org/data/2.5/forecast', {
+    result = http_sessions.get_session('open_weather').get(f'{open_weather_url}/data/2.5/forecast', {
         'lat': lat,
         'lon':lon,
         'units':units,
-        'appid': open_weather_api_key,
+        'appid': get_open_weather_api_key(),
     }, timeout=3)
     result.raise_for_status()
-    return result.json()
+    return forecast_model.hourly_from_open_weather(result.json())
 
 
-#Units can be 'imperial', 'metric', or 'standard' (i.e. Kelvin)
+#Units can be 'imperial', 'metric', or 'standard' (i.e. Kelvin). Returns forecast_model.CurrentConditions
+@forecast_cache.cached('current', 'open_weather')
+@metrics.traced
 def get_open_weather_current_weather(lat, lon, units='imperial'):
     if units not in ['imperial', 'metric', 'standard']:
         raise ValueError("Unknown Units Type")
-    result = requests.get('https://api.openweathermap.org/data/2.5/weather', {
+    result = http_sessions.get_session('open_weather').get(f'{open_weather_url}/data/2.5/weather', {
         'lat': lat,
         'lon':lon,
         'units':units,
-        'appid': open_weather_api_key,
+        'appid': get_open_weather_api_key(),
     }, timeout=3)
     result.raise_for_status()
-    return result.json()
+    return forecast_model.current_from_open_weather(result.json())
 
 #Based on mercator projection code from https://developers.google.com/maps/documentation/javascript/examples/map-coordinates
 def mercator_projection(lat, lon, tile_size=256):
@@ -79,71 +103,155 @@ def mercator_projection(lat, lon, tile_size=256):
     return (tile_size * (0.5 + lon / 360), tile_size * (0.5 - math.log((1 + siny) / (1 - siny)) / (4 * math.pi)))
 
 
+#Inverse of mercator_projection, world coordinates back to (lat, lon)
+def inverse_mercator_projection(x, y, tile_size=256):
+    lon = (x / tile_size - 0.5) * 360
+    lat = math.degrees(2 * math.atan(math.exp((0.5 - y / tile_size) * 2 * math.pi)) - math.pi / 2)
+    return (lat, lon)
+
+
+#Map tile (x, y) containing the location at the given zoom level
+def tile_coordinates(lat, lon, zoom, tile_size=256):
+    (x, y) = mercator_projection(lat, lon, tile_size)
+    scale = 2 ** zoom
+    return (math.floor(x * scale / tile_size), math.floor(y * scale / tile_size))
+
+
 #Based on https://www.freecodecamp.org/news/how-to-get-location-information-of-ip-address-using-python/
+@metrics.traced
 def get_ip():
-    response = requests.get('https://api64.ipify.org?format=json').json()
+    response = http_sessions.get_session('ip_location').get(f'{ipify_url}?format=json', timeout=3).json()
     return response["ip"]
 
-def get_location():
-    ip_address = get_ip()
-    response = requests.get(f'https://ipapi.co/{ip_address}/json/').json()
+#Rough location of an IP address, the server's own public address when none is given
+@metrics.traced
+def get_location(ip_address=None):
+    if ip_address is None:
+        ip_address = get_ip()
+    response = http_sessions.get_session('ip_location').get(f'{ipapi_url}/{ip_address}/json/', timeout=3).json()
     location_data = {
         "ip": ip_address,
         "city": response.get("city"),
         "region": response.get("region"),
-        "country": response.get("country_name")
+        "country": response.get("country_name"),
+        "lat": response.get("latitude"),
+        "lon": response.get("longitude")
     }
     return location_data
 
 
-def get_openmeteo_weather(lat, lon, temp_unit='fahrenheit'):
+#Daily variables requested from Open-Meteo and the forecast_model.DailyForecast columns they fill
+openmeteo_daily_variables = [
+    ('temperature_2m_max', 'max_temperature'),
+    ('temperature_2m_min', 'min_temperature'),
+    ('apparent_temperature_max', 'max_feels_like'),
+    ('apparent_temperature_min', 'min_feels_like'),
+    ('precipitation_probability_max', 'precipitation_chance'),
+    ('weather_code', 'weather_code'),
+]
+#Open-Meteo takes lists of coordinates; this many locations are sent per request
+openmeteo_batch_size = 100
+
+
+#Daily forecasts for many (lat, lon) locations in one columnar result, with the location as the first dimension.
+#Days run from local midnight at each location, like forecast_model.daily_from_hourly's, and 'UTC Offset' is its offset:
+#   {'Latitude': (N,), 'Longitude': (N,), 'UTC Offset': (N,), 'Dates': (N, days) epoch seconds,
+#    'Daily': {column: (N, days)}}
+@metrics.traced
+def get_openmeteo_weather_batch(coordinates, temp_unit='fahrenheit'):
     if temp_unit not in ['fahrenheit', 'celsius']:
         raise ValueError('Unknown Temperature Unit')
 
-    cache_session = requests_cache.CachedSession('.cache', expire_after=3600)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
-    url = "https://api.open-meteo.com/v1/forecast"
+    openmeteo = http_sessions.get_openmeteo_client()
+    url = f"{open_meteo_url}/v1/forecast"
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    responses = []
+    for start in range(0, len(coordinates), openmeteo_batch_size):
+        chunk = coordinates[start:start + openmeteo_batch_size]
+        params = {
+            'latitude': chunk[:, 0].tolist(),
+            'longitude': chunk[:, 1].tolist(),
+            "daily": [variable for (variable, name) in openmeteo_daily_variables],
+            "temperature_unit": temp_unit,
+            "timezone": "auto"
+        }
+        responses += openmeteo.weather_api(url, params=params)
+
+    daily = responses[0].Daily()
+    num_days = (daily.TimeEnd() - daily.Time()) // daily.Interval()
+    utc_offsets = np.empty(len(responses), dtype=np.int32)
+    dates = np.empty((len(responses), num_days), dtype=np.int64)
+    values = np.empty((len(openmeteo_daily_variables), len(responses), num_days), dtype=np.float32)
+    for (i, response) in enumerate(responses):
+        daily = response.Daily()
+        utc_offsets[i] = response.UtcOffsetSeconds()
+        dates[i] = np.arange(daily.Time(), daily.Time() + num_days * daily.Interval(), daily.Interval())
+        for j in range(len(openmeteo_daily_variables)):
+            values[j, i] = daily.Variables(j).ValuesAsNumpy()[:num_days]
+    weather_dict = {
+        'Latitude': coordinates[:, 0],
+        'Longitude': coordinates[:, 1],
+        'UTC Offset': utc_offsets,
+        'Dates': dates,
+        'Daily': {name: values[j] for (j, (variable, name)) in enumerate(openmeteo_daily_variables)},
+    }
+    weather_dict['Daily']['weather_code'] = weather_dict['Daily']['weather_code'].astype(np.int16)
+    return weather_dict
+
+
+@forecast_cache.batched('daily')
+def get_openmeteo_weather_many(coordinates, temp_unit='fahrenheit'):
+    batch = get_openmeteo_weather_batch(coordinates, temp_unit)
+    return [forecast_model.daily_from_open_meteo(batch, i) for i in range(len(coordinates))]
+
+
+#Current variables for get_openmeteo_current_weather, in the order forecast_model.current_from_open_meteo reads them
+openmeteo_current_variables = ["temperature_2m", "relative_humidity_2m", "apparent_temperature", "rain", "weather_code",
+                               "is_day"]
+
+
+#Current conditions from Open-Meteo as forecast_model.CurrentConditions, standing in for OpenWeather when it is slow
+#or failing. Cached under its own data type, with the same time to live as OpenWeather's current conditions.
+@forecast_cache.cached('current_open_meteo', 'open_meteo')
+@metrics.traced
+def get_openmeteo_current_weather(lat, lon, temp_unit='fahrenheit'):
+    if temp_unit not in ['fahrenheit', 'celsius']:
+        raise ValueError('Unknown Temperature Unit')
+
+    openmeteo = http_sessions.get_openmeteo_client()
     params = {
         'latitude': lat,
         'longitude': lon,
-        "current": ["temperature_2m", "relative_humidity_2m", "apparent_temperature", "precipitation", "rain"],
-        "hourly": ["temperature_2m", "relative_humidity_2m", "apparent_temperature", "precipitation_probability",
-                   "precipitation"],
-        "daily": ["temperature_2m_max", "temperature_2m_min", "apparent_temperature_max",
-                  "apparent_temperature_min", "precipitation_probability_max", "weather_code"],
+        "current": openmeteo_current_variables,
         "temperature_unit": temp_unit
     }
-    response = openmeteo.weather_api(url, params=params)[0]
-    weather_dict = {}
-    daily = response.Daily()
-    weather_dict['Daily'] = {}
-    weather_dict['Daily']['Max Temperature'] = daily.Variables(0).ValuesAsNumpy().tolist()
-    weather_dict['Daily']['Min Temperature'] = daily.Variables(1).ValuesAsNumpy().tolist()
-    weather_dict['Daily']['Max Apparent Temperature'] = daily.Variables(2).ValuesAsNumpy().tolist()
-    weather_dict['Daily']['Min Apparent Temperature'] = daily.Variables(3).ValuesAsNumpy().tolist()
-    weather_dict['Daily']['Precipitation Chance'] = daily.Variables(4).ValuesAsNumpy().tolist()
-    weather_dict['Daily']['Weather Code'] = daily.Variables(5).ValuesAsNumpy().astype(int).tolist()
-    timestamps = pd.date_range(start=pd.to_datetime(daily.Time(), unit='s', utc=True),
-                                                   end=pd.to_datetime(daily.TimeEnd(), unit='s', utc=True),
-                                                   freq=pd.Timedelta(seconds=daily.Interval())).tolist()
-    dates = [ts.to_pydatetime() for ts in timestamps]
-    weather_dict['Daily']['Dates'] = dates
-    return weather_dict
+    response = openmeteo.weather_api(f"{open_meteo_url}/v1/forecast", params=params)[0]
+    return forecast_model.current_from_open_meteo(response)
 
 
+#Daily forecast for one location as a forecast_model.DailyForecast
+@forecast_cache.cached('daily', 'open_meteo')
+def get_openmeteo_weather(lat, lon, temp_unit='fahrenheit'):
+    return forecast_model.daily_from_open_meteo(get_openmeteo_weather_batch([(lat, lon)], temp_unit), 0)
+
+
+@metrics.traced
 def get_weather_gov_weather(lat, lon):
-    response = requests.get(f'https://api.weather.gov/points/{lat},{lon}').json()
-    return response
+    result = http_sessions.get_session('weather_gov').get(f'{weather_gov_url}/points/{lat},{lon}')
+    result.raise_for_status()
+    return result.json()
 
 
+@metrics.traced
 def get_alerts_gov_weather(lat, lon):
-    response = requests.get(f'https://api.weather.gov/alerts/active', {'point': f'{lat},{lon}'}).json()
+    response = http_sessions.get_session('weather_gov').get(f'{weather_gov_url}/alerts/active', {'point': f'{lat},{lon}'}).json()
     return response
 
+@metrics.traced
 def get_alerts_gov_weather_zone(zone):
-    response = requests.get(f'https://api.weather.gov/alerts/active', {'zone': zone}).json()
-    return response
+    result = http_sessions.get_session('weather_gov').get(f'{weather_gov_url}/alerts/active', {'zone': zone})
+    result.raise_for_status()
+    return result.json()
 
 
 #Takes WMO weather numeric code and returns material icon name if available
@@ -0,0 +1,121 @@
+import os
+import threading
+import weakref
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
+
+#Process-wide registry of pooled HTTP sessions, one per upstream provider. Each session keeps its own keep-alive
+#connection pools per host, so page refreshes reuse TCP/TLS connections instead of handshaking every call.
+
+#Retry/backoff policy per provider. Retries stay short; provider_router covers slow or failing providers. Once the
+#retries of a 5xx run out the last response is returned, so raise_for_status() raises an HTTPError for it.
+provider_retry_policies = {
+    'open_weather': {'retries': 2, 'backoff_factor': 0.2},
+    'open_weather_tiles': {'retries': 1, 'backoff_factor': 0.2},
+    'open_meteo': {'retries': 2, 'backoff_factor': 0.2},
+    'weather_gov': {'retries': 2, 'backoff_factor': 0.5},
+    'ip_location': {'retries': 1, 'backoff_factor': 0.2},
+}
+#Providers whose responses go through the shared requests_cache backend
+cached_providers = {'open_meteo'}
+#requests_cache file name, without the .sqlite suffix. Worker processes on one host can share it.
+cache_name = os.environ.get('HTTP_CACHE', '.cache')
+cache_expire_after = 3600
+pool_maxsize = 16
+
+_lock = threading.Lock()
+_sessions = {}
+_adapters = {}
+_cache_backend = None
+_openmeteo_client = None
+
+
+#HTTPAdapter that remembers the connection pools it hands out so their connection counters can be reported
+class PoolTrackingAdapter(HTTPAdapter):
+    def __init__(self, *args, **kwargs):
+        self.seen_pools = weakref.WeakSet()
+        super().__init__(*args, **kwargs)
+
+    def get_connection_with_tls_context(self, *args, **kwargs):
+        pool = super().get_connection_with_tls_context(*args, **kwargs)
+        self.seen_pools.add(pool)
+        return pool
+
+
+def _make_adapter(provider):
+    policy = provider_retry_policies.get(provider, {'retries': 0, 'backoff_factor': 0})
+    max_retries = Retry(total=policy['retries'], read=policy['retries'], connect=policy['retries'],
+                        backoff_factor=policy['backoff_factor'], status_forcelist=(500, 502, 504),
+                        allowed_methods=None, raise_on_status=False)
+    return PoolTrackingAdapter(pool_connections=8, pool_maxsize=pool_maxsize, max_retries=max_retries)
+
+
+#The single cache backend, created the first time it is needed and shared by every cached provider. requests_cache is
+#imported here rather than at the top, since only Open-Meteo needs it and it is slow to import. Write-ahead logging
+#lets worker processes sharing the file read while one of them writes.
+def get_cache_backend():
+    global _cache_backend
+    import requests_cache
+    with _lock:
+        if _cache_backend is None:
+            _cache_backend = requests_cache.SQLiteCache(cache_name, wal=True)
+        return _cache_backend
+
+
+def get_session(provider):
+    session = _sessions.get(provider)
+    if session is not None:
+        return session
+    backend = get_cache_backend() if provider in cached_providers else None
+    with _lock:
+        if provider not in _sessions:
+            if backend is not None:
+                import requests_cache
+                session = requests_cache.CachedSession(backend=backend, expire_after=cache_expire_after)
+            else:
+                session = requests.Session()
+            adapter = _make_adapter(provider)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.hooks['response'].append(metrics.response_hook(provider, backend is not None))
+            _adapters[provider] = adapter
+            _sessions[provider] = session
+        return _sessions[provider]
+
+
+def get_openmeteo_client():
+    global _openmeteo_client
+    if _openmeteo_client is None:
+        import openmeteo_requests
+        session = get_session('open_meteo')
+        with _lock:
+            if _openmeteo_client is None:
+                _openmeteo_client = openmeteo_requests.Client(session=session)
+    return _openmeteo_client
+
+
+#Connection reuse per provider. A miss is a request that had to open a new connection, a hit reused a pooled one.
+#Returns {provider: {'hits': int, 'misses': int}}
+def pool_stats():
+    stats = {}
+    with _lock:
+        adapters = dict(_adapters)
+    for provider, adapter in adapters.items():
+        hits = misses = 0
+        for pool in list(adapter.seen_pools):
+            misses += pool.num_connections
+            hits += max(pool.num_requests - pool.num_connections, 0)
+        stats[provider] = {'hits': hits, 'misses': misses}
+    return stats
+
+
+def close_all():
+    global _openmeteo_client
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _adapters.clear()
+        _openmeteo_client = None
@@ -0,0 +1,156 @@
+import bisect
+import collections
+import csv
+import ipaddress
+import os
+import threading
+import time
+import async_weather
+
+#Rough location of a page's client from its IP address, for the first forecast before the user searches. Answers
+#come from, in order:
+#   1. an optional local CSV of IP ranges, searched with a binary search
+#   2. a cache of earlier answers per network prefix, since neighbouring addresses are almost always in the same place
+#   3. ipapi.co, whose answer is then cached
+#Clients on a private or loopback address, e.g. during development, get the server's own public location.
+
+#CSV with start,end,city,region,country,lat,lon columns, start and end being the first and last address of a range
+ip_ranges_path = os.environ.get('IP_LOCATION_CSV', '')
+#Take the client's address from X-Forwarded-For. Only turn on behind a reverse proxy that appends to the header, as
+#clients can send any X-Forwarded-For they like.
+trust_forwarded_for = os.environ.get('TRUST_X_FORWARDED_FOR', '0') == '1'
+#Seconds an ipapi.co answer is reused for its network prefix
+cache_ttl = 24 * 60 * 60
+cache_max_entries = 16384
+#Addresses sharing this many leading bits share a cache entry
+ipv4_prefix_length = 24
+ipv6_prefix_length = 48
+
+
+#Client address of a request, or None when it is private, loopback or missing
+def client_ip(request):
+    address = None
+    if trust_forwarded_for:
+        #The last address is the one the proxy appended; the ones before it came from the client
+        forwarded_for = request.headers.get('x-forwarded-for', '')
+        address = forwarded_for.split(',')[-1].strip() or None
+    if address is None and request.client is not None:
+        address = request.client.host
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return None
+    if ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_unspecified:
+        return None
+    return str(ip)
+
+
+def ip_prefix(address):
+    ip = ipaddress.ip_address(address)
+    prefix_length = ipv4_prefix_length if ip.version == 4 else ipv6_prefix_length
+    return str(ipaddress.ip_network(f'{ip}/{prefix_length}', strict=False))
+
+
+#Sorted, non-overlapping IP ranges per IP version with a location each
+class IPRanges():
+    def __init__(self):
+        self.starts = {4: [], 6: []}
+        self.ends = {4: [], 6: []}
+        self.locations = {4: [], 6: []}
+
+    @classmethod
+    def from_csv(cls, path):
+        rows = []
+        with open(path, newline='', encoding='utf-8') as csv_file:
+            for row in csv.DictReader(csv_file):
+                (start, end) = (ipaddress.ip_address(row['start']), ipaddress.ip_address(row['end']))
+                location = {'city': row.get('city', ''), 'region': row.get('region', ''),
+                            'country': row.get('country', ''), 'lat': float(row['lat']), 'lon': float(row['lon'])}
+                rows.append((start.version, int(start), int(end), location))
+        ranges = cls()
+        for (version, start, end, location) in sorted(rows, key=lambda row: (row[0], row[1])):
+            ranges.starts[version].append(start)
+            ranges.ends[version].append(end)
+            ranges.locations[version].append(location)
+        return ranges
+
+    def lookup(self, address):
+        ip = ipaddress.ip_address(address)
+        position = bisect.bisect_right(self.starts[ip.version], int(ip)) - 1
+        if position >= 0 and int(ip) <= self.ends[ip.version][position]:
+            return self.locations[ip.version][position]
+        return None
+
+    def __len__(self):
+        return len(self.starts[4]) + len(self.starts[6])
+
+
+#Network prefix -> (expires, location), least recently used first
+class LocationCache():
+    def __init__(self, ttl=cache_ttl, max_entries=cache_max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, prefix, now=None):
+        with self._lock:
+            entry = self._entries.get(prefix)
+            if entry is None or entry[0] <= (now or time.time()):
+                return None
+            self._entries.move_to_end(prefix)
+            return entry[1]
+
+    def put(self, prefix, location, now=None):
+        with self._lock:
+            self._entries[prefix] = ((now or time.time()) + self.ttl, location)
+            self._entries.move_to_end(prefix)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+ip_ranges = None
+cache = LocationCache()
+
+
+def load_ip_ranges(path):
+    global ip_ranges
+    ip_ranges = IPRanges.from_csv(path)
+    print(f'Loaded {len(ip_ranges)} IP ranges from {path}')
+    return ip_ranges
+
+
+#Loads the IP range CSV configured through IP_LOCATION_CSV, if any
+def init():
+    if ip_ranges_path and ip_ranges is None:
+        load_ip_ranges(ip_ranges_path)
+
+
+#Location known without a network call, or None
+def local_lookup(address):
+    location = None
+    if address and ip_ranges is not None:
+        location = ip_ranges.lookup(address)
+    if location is None:
+        location = cache.get(ip_prefix(address) if address else 'server')
+    return location
+
+
+#{'city', 'region', 'country', 'lat', 'lon'} for a client address, where None means the server's own address
+async def rough_location(address):
+    location = local_lookup(address)
+    if location is not None:
+        return location
+    key = ip_prefix(address) if address else 'server'
+    location = await async_weather.get_location(address)
+    #Error and rate limit answers come without coordinates and are not worth keeping
+    if location.get('lat') is not None and location.get('lon') is not None:
+        cache.put(key, location)
+    return location
+
+
+def stats():
+    return {'cached_prefixes': len(cache), 'ip_ranges': len(ip_ranges) if ip_ranges is not None else 0}
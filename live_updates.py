@@ -0,0 +1,117 @@
+import asyncio
+import os
+import async_weather
+import forecast_cache
+import forecast_view
+import metrics
+
+#Keeps open pages current without a reload. Each page subscribes to the location it shows and its temperature scale.
+#There is one refresh task per grid cell being watched, however many tabs show it: every refresh_interval it gets the
+#cell's forecasts once and, when they changed, builds one page view per distinct place and scale and pushes it to
+#every subscriber. A refresh cycle therefore costs one forecast lookup per watched cell, not per tab. Alerts for the
+#location are already pushed to the page by alerts.service.
+
+#Seconds between refreshes of a watched location
+refresh_interval = float(os.environ.get('LIVE_REFRESH_SECONDS', 60))
+
+
+#The forecasts of a grid cell, and the subscribers that were given them
+class Channel():
+    def __init__(self):
+        self.tokens = set()
+        self.forecasts = None
+        self.task = None
+
+
+class Broadcaster():
+    def __init__(self):
+        #token -> [cell, name, lat, lon, scale, callback]
+        self._subscribers = {}
+        #grid cell -> Channel
+        self._channels = {}
+        self._next_token = 0
+        self.refreshes = 0
+        self.updates = 0
+        self.views = 0
+        self.pushes = 0
+
+    #Calls callback(page view) whenever the forecasts for the location change, the view being built like
+    #forecast_view.page_view(name, lat, lon, ..., scale). forecasts are the (current, hourly, daily) the page already
+    #shows, if any, so they are not pushed again. Returns a token for set_scale and unsubscribe.
+    def subscribe(self, name, lat, lon, scale, callback, forecasts=None):
+        token = self._next_token
+        self._next_token += 1
+        cell = forecast_cache.quantize(lat, lon)
+        self._subscribers[token] = [cell, name, lat, lon, scale, callback]
+        channel = self._channels.get(cell)
+        if channel is None:
+            channel = self._channels[cell] = Channel()
+            channel.forecasts = forecasts
+            channel.task = asyncio.create_task(self._run(cell, channel))
+        channel.tokens.add(token)
+        return token
+
+    def set_scale(self, token, scale):
+        if token in self._subscribers:
+            self._subscribers[token][4] = scale
+
+    def unsubscribe(self, token):
+        subscriber = self._subscribers.pop(token, None)
+        if subscriber is None:
+            return
+        channel = self._channels[subscriber[0]]
+        channel.tokens.discard(token)
+        if not channel.tokens:
+            channel.task.cancel()
+            del self._channels[subscriber[0]]
+
+    def stop(self):
+        for channel in self._channels.values():
+            channel.task.cancel()
+        self._channels.clear()
+        self._subscribers.clear()
+
+    async def _run(self, cell, channel):
+        while True:
+            await asyncio.sleep(refresh_interval)
+            try:
+                await self.refresh(cell, channel)
+            except Exception as e:
+                print('Live update problem for', cell, e)
+
+    #Gets the cell's forecasts, straight from the forecast cache when it has them, and pushes them to the subscribers
+    #if they changed since the last refresh. Stale cache entries are served here and revalidated in the background by
+    #refresh_scheduler, so the next refresh picks up the new ones.
+    async def refresh(self, cell, channel):
+        with metrics.trace('live_update'):
+            with metrics.stage('forecast'):
+                forecasts = async_weather.cached_forecasts(*cell) or await async_weather.get_forecasts(*cell)
+            self.refreshes += 1
+            if channel.forecasts is not None and all(new is old for (new, old) in zip(forecasts, channel.forecasts)):
+                metrics.annotate(outcome='unchanged')
+                return
+            channel.forecasts = forecasts
+            self.updates += 1
+            #Subscribers showing the same place in the same scale share one view
+            views = {}
+            for token in list(channel.tokens):
+                (name, lat, lon, scale, callback) = self._subscribers[token][1:]
+                view = views.get((name, lat, lon, scale))
+                if view is None:
+                    with metrics.stage('view'):
+                        view = views[(name, lat, lon, scale)] = forecast_view.page_view(name, lat, lon, *forecasts,
+                                                                                        scale)
+                    self.views += 1
+                try:
+                    with metrics.stage('push'):
+                        callback(view)
+                    self.pushes += 1
+                except Exception as e:
+                    print('Live update subscriber problem:', e)
+
+    def stats(self):
+        return {'subscribers': len(self._subscribers), 'locations': len(self._channels), 'refreshes': self.refreshes,
+                'updates': self.updates, 'views': self.views, 'pushes': self.pushes}
+
+
+broadcaster = Broadcaster()
@@ -1,16 +1,64 @@
+import asyncio
 import math
+import os
 
-from nicegui import  ui, app
+from nicegui import  ui, app, background_tasks
 import datetime
-import usaddress
 from requests import HTTPError
-import re
-import get_weather
+from fastapi import Request, Response
+import async_weather
+import geocoding
+import forecast_view
+import pushed_view
+import http_sessions
 import mapping
+import tile_proxy
+import forecast_api
+import refresh_scheduler
+import alerts
+import ip_location
+import metrics
+import forecast_cache
+import provider_router
+import live_updates
 
 app.add_static_files('/weather_icons', 'icons/makin_things_icons')
+#Opening the Open-Meteo response cache imports requests_cache, so it happens off the event loop while the server is
+#already taking requests
+app.on_startup(lambda: background_tasks.create(asyncio.to_thread(http_sessions.get_cache_backend),
+                                               name='open response cache'))
+app.on_startup(lambda: background_tasks.create(asyncio.to_thread(tile_proxy.get_tile_cache),
+                                               name='index tile cache'))
+app.on_startup(geocoding.init)
+app.on_startup(ip_location.init)
+app.on_startup(refresh_scheduler.scheduler.start)
+app.on_startup(lambda: background_tasks.create(refresh_scheduler.warm_up(), name='warm forecasts'))
+app.on_startup(alerts.service.start)
+app.on_shutdown(refresh_scheduler.scheduler.stop)
+app.on_shutdown(alerts.service.stop)
+app.on_shutdown(live_updates.broadcaster.stop)
+app.on_shutdown(http_sessions.close_all)
+#Counters of the caches and background services, served next to the timings on /metrics
+metrics.collectors.update({
+    'forecast_cache': forecast_cache.default_cache.stats,
+    'coalescing': async_weather.coalescing_stats,
+    'http_pools': lambda: {'connections': http_sessions.pool_stats()},
+    'provider_router': provider_router.router.stats,
+    'refresh_scheduler': refresh_scheduler.scheduler.stats,
+    'alerts': alerts.service.stats,
+    'ip_location': ip_location.stats,
+    'forecast_api': forecast_api.stats,
+    'live_updates': live_updates.broadcaster.stats,
+    'pushed_view': pushed_view.stats,
+})
 ui.colors(primary='#555')
 
+
+#Prometheus scrape target, see metrics.py
+@app.get('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), media_type=metrics.content_type)
+
 class Location():
     def __init__(self, name, lat, lon):
         self.name = name
@@ -41,7 +89,7 @@ class DarkButton(ui.button):
         super().update()
 
 @ui.page('/')
-async def weather_page():
+async def weather_page(request: Request):
     class DailyWeather(ui.card):
         def __init__(self, date=None, high=None, low=None, precipitation=None, icon=None, *args, **kwargs) -> None:
             super().__init__(*args, **kwargs)
@@ -129,15 +177,65 @@ async def weather_page():
         print(f'Browser Location: ({lat}, {lon})')
         await update_weather(lat_lon=(lat, lon))
 
+    #Forecasts are kept in the canonical unit, so a unit change only re-renders what is already on the page
     async def on_temp_scale_toggle():
         print('toggled temp scale')
-        await update_weather(use_previous_location=True)
+        with metrics.trace('toggle_units'):
+            render_weather()
+        live_updates.broadcaster.set_scale(live_subscription, temp_scale_selector.value)
         #app.storage.browser['temp_scale'] = temp_scale_selector.value
 
+    #Type-ahead suggestions from the gazetteer, computed once typing pauses for suggestion_delay seconds
+    suggestion_delay = 0.15
+    suggestion_task = None
+    chosen_suggestion = None
+    def on_location_typed(e):
+        nonlocal suggestion_task
+        if suggestion_task:
+            suggestion_task.cancel()
+        if len((e.value or '').strip()) < 2 or e.value == chosen_suggestion:
+            suggestion_menu.close()
+            return
+        suggestion_task = asyncio.create_task(show_suggestions(e.value))
+
+    async def show_suggestions(text):
+        await asyncio.sleep(suggestion_delay)
+        suggestions = geocoding.suggest(text)
+        suggestion_menu.clear()
+        if not suggestions:
+            suggestion_menu.close()
+            return
+        with suggestion_menu:
+            for place in suggestions:
+                ui.menu_item(place['name'], on_click=lambda place=place: on_suggestion_chosen(place))
+        suggestion_menu.open()
+
+    #Suggestions are already resolved, so the weather is fetched without usaddress or the remote geocoder
+    async def on_suggestion_chosen(place):
+        nonlocal chosen_suggestion
+        chosen_suggestion = place['name']
+        suggestion_menu.close()
+        set_location_input.set_value(place['name'])
+        await update_weather(lat_lon=(place['lat'], place['lon']), location_name=place['name'])
+
+    #The last location this browser looked at wins, then the client's IP address, see ip_location.py
     async def weather_from_rough_location():
-        rough_ip_location = get_weather.get_location()
-        await update_weather(place_name=rough_ip_location['city'], state_name=rough_ip_location['region'],
-                             country_name=rough_ip_location['country'])
+        last_location = app.storage.user.get('last_location')
+        if last_location:
+            await update_weather(lat_lon=(last_location['lat'], last_location['lon']),
+                                 location_name=last_location['name'])
+            return
+        try:
+            rough_ip_location = await ip_location.rough_location(ip_location.client_ip(request))
+        except Exception as e:
+            print('Rough location problem:', e)
+            return
+        if rough_ip_location.get('lat') is not None and rough_ip_location.get('lon') is not None:
+            name = ', '.join(part for part in (rough_ip_location['city'], rough_ip_location['region']) if part)
+            await update_weather(lat_lon=(rough_ip_location['lat'], rough_ip_location['lon']), location_name=name)
+        else:
+            await update_weather(place_name=rough_ip_location['city'], state_name=rough_ip_location['region'],
+                                 country_name=rough_ip_location['country'])
 
     with ui.footer(value=False) as footer:
         ui.label('Footer')
@@ -155,14 +253,15 @@ async def weather_page():
                 ui.label('Weather Stuff').classes('text-h3')
             #ui.space()
             with ui.element('div').classes('absolute-center').style('display: flex; align-items: flex-start;'):
-                set_location_input = ui.input(label='Location').on(
+                set_location_input = ui.input(label='Location', on_change=on_location_typed).on(
                     'keydown.enter',
                     lambda e: update_weather(e.sender.value))# .on('blur', lambda e: update_weather(e.sender.value))
                 ui.button(on_click=on_get_browser_location, icon='location_on').props('round dense color=accent size="sm"').style('margin-top: 1.5em')
+                suggestion_menu = ui.menu().props('no-parent-event no-focus')
             #ui.space()
             with ui.element('div').classes('absolute-right').style('margin-top: 1em; margin-right: 1em'):
                 temp_scale_selector = ui.toggle(
-                    {'F': u'\N{DEGREE SIGN}F', 'C': u'\N{DEGREE SIGN}C'}, value='F',
+                    {'F': u'\N{DEGREE SIGN}F', 'C': u'\N{DEGREE SIGN}C', 'K': 'K'}, value='F',
                     on_change=on_temp_scale_toggle).props('rounded color="dark" toggle-color="positive"')
                 DarkButton().classes('justify-right')
         with ui.row().classes('w-full') as header_row_2:
@@ -170,6 +269,7 @@ async def weather_page():
                 with ui.row():
                     ui.label('Location: ')
                     location_label = ui.label('')
+                alerts_column = ui.column().classes('gap-1')
 
 
     with ui.tabs() as tabs:
@@ -253,133 +353,255 @@ async def weather_page():
         ui.label('Error: An Error was encountered. Please try again later.')
         ui.button('Close', on_click=general_error_dialog.close)
 
+    #The spinner only shows when an update takes noticeably long, which cached and stale-while-revalidate data never do
+    loading_delay = 0.3
+    #Updates can overlap, e.g. a search during a refresh, so the dialog goes once the last one has finished
+    loading_timer = None
+    loads_in_progress = 0
+    def show_loading():
+        nonlocal loading_timer, loads_in_progress
+        loads_in_progress += 1
+        if loading_timer is None:
+            loading_timer = asyncio.get_running_loop().call_later(loading_delay, loading_dialog.open)
+
+    def hide_loading():
+        nonlocal loading_timer, loads_in_progress
+        loads_in_progress = max(loads_in_progress - 1, 0)
+        if loads_in_progress:
+            return
+        if loading_timer is not None:
+            loading_timer.cancel()
+            loading_timer = None
+        loading_dialog.close()
+
     last_updated_weather_time = None
     last_weather_location = None
-    last_weather_unit = temp_scale_selector.value
-    async def update_weather(location_string='', place_name='', state_name='', country_name='', zip_code='', lat_lon=None, use_previous_location=False):
-        if not (use_previous_location or location_string.strip() or place_name or state_name or country_name or zip_code or lat_lon):
-            return
-        #Don't update if updated recently with same query
-        nonlocal last_updated_weather_time, last_weather_location, last_weather_unit
-        update_time = datetime.datetime.now()
-        if (not use_previous_location and
-                last_weather_location and
-                (last_weather_location.name == location_string) and
-                last_updated_weather_time and
-                (last_updated_weather_time - update_time) < datetime.timedelta(seconds=10) and
-                last_weather_unit == temp_scale_selector.value):
-            return
-        loading_dialog.open()
-        if use_previous_location:
-            if last_weather_location is None:
+    last_weather_data = None
+    #What this client's page currently shows, so renders only send the elements that changed
+    view = pushed_view.PushedView()
+    async def update_weather(location_string='', place_name='', state_name='', country_name='', zip_code='', lat_lon=None, location_name='', use_previous_location=False):
+        #Every update is timed stage by stage, see metrics.py
+        with metrics.trace('update_weather'):
+            if not (use_previous_location or location_string.strip() or place_name or state_name or country_name or zip_code or lat_lon):
+                metrics.annotate(outcome='skipped')
                 return
-            (lat, lon) = (last_weather_location.lat, last_weather_location.lon)
-            open_weather_geocode = get_weather.get_open_weather_reverse_geocode(lat, lon)
-            print(open_weather_geocode)
-        elif lat_lon:
-            print('lat lon')
-            (lat, lon) = lat_lon
-            if last_weather_location and (last_weather_location.lat == lat) and \
-                    (last_weather_location.lon == lon):
+            #Don't update if updated recently with same query
+            nonlocal last_updated_weather_time, last_weather_location, last_weather_data
+            update_time = datetime.datetime.now()
+            if (not use_previous_location and
+                    location_string and
+                    last_weather_location and
+                    (last_weather_location.name == location_string) and
+                    last_updated_weather_time and
+                    (update_time - last_updated_weather_time) < datetime.timedelta(seconds=10)):
+                metrics.annotate(outcome='skipped')
                 return
-            open_weather_geocode = get_weather.get_open_weather_reverse_geocode(lat, lon)
-        else:
-            (tagged_location, location_type) = usaddress.tag(location_string)
-            if place_name:
-                tagged_location['PlaceName'] = place_name
-            if state_name:
-                tagged_location['StateName'] = state_name
-            if country_name:
-                tagged_location['CountryName'] = country_name
-            if zip_code:
-                tagged_location['ZipCode'] = zip_code
+            show_loading()
             try:
-                open_weather_geocode = get_weather.get_open_weather_geocode(tagged_location)
-            except ValueError as e:
-                loading_dialog.close()
-                bad_location_dialog.open()
-                return
-            except HTTPError as e:
-                loading_dialog.close()
-                request_error_dialog.open()
-                return
-            except Exception as e:
-                print(e)
-                loading_dialog.close()
-                general_error_dialog.open()
-                return
-            (lat, lon) = (open_weather_geocode['lat'], open_weather_geocode['lon'])
-        try:
-            open_weather_current = get_weather.get_open_weather_current_weather(lat, lon, units=get_weather.open_weather_units[temp_scale_selector.value])
-            open_weather_five_day = get_weather.get_open_weather_five_day_forcast(lat, lon, units=get_weather.open_weather_units[temp_scale_selector.value])
-            open_meteo_weather = get_weather.get_openmeteo_weather(lat, lon, get_weather.open_meteo_units[temp_scale_selector.value])
-        except HTTPError as e:
-            print('Weather Data problem')
-            loading_dialog.close()
-            request_error_dialog.open()
+                if use_previous_location:
+                    if last_weather_location is None:
+                        metrics.annotate(outcome='skipped')
+                        return
+                    (lat, lon) = (last_weather_location.lat, last_weather_location.lon)
+                    with metrics.stage('geocode'):
+                        open_weather_geocode = await async_weather.reverse_geocode(lat, lon)
+                    print(open_weather_geocode)
+                elif lat_lon:
+                    print('lat lon')
+                    (lat, lon) = lat_lon
+                    if last_weather_location and (last_weather_location.lat == lat) and \
+                            (last_weather_location.lon == lon):
+                        metrics.annotate(outcome='skipped')
+                        return
+                    if location_name:
+                        open_weather_geocode = {'name': location_name, 'lat': lat, 'lon': lon}
+                    else:
+                        with metrics.stage('geocode'):
+                            open_weather_geocode = await async_weather.reverse_geocode(lat, lon)
+                else:
+                    try:
+                        with metrics.stage('geocode'):
+                            open_weather_geocode = await async_weather.geocode(location_string, place_name, state_name,
+                                                                               country_name, zip_code)
+                    except ValueError as e:
+                        bad_location_dialog.open()
+                        metrics.annotate(outcome='bad_location')
+                        return
+                    except HTTPError as e:
+                        request_error_dialog.open()
+                        metrics.annotate(outcome='upstream_error')
+                        return
+                    except Exception as e:
+                        print(e)
+                        general_error_dialog.open()
+                        metrics.annotate(outcome='error')
+                        return
+                    (lat, lon) = (open_weather_geocode['lat'], open_weather_geocode['lon'])
+                metrics.annotate(lat=lat, lon=lon)
+                try:
+                    with metrics.stage('forecast'):
+                        (current, hourly, daily) = await async_weather.get_forecasts(lat, lon)
+                except HTTPError as e:
+                    print('Weather Data problem')
+                    request_error_dialog.open()
+                    metrics.annotate(outcome='upstream_error')
+                    return
+                except Exception as e:
+                    print(e)
+                    general_error_dialog.open()
+                    metrics.annotate(outcome='error')
+                    return
+
+                last_updated_weather_time = update_time
+                last_weather_location = Location(location_string, lat, lon)
+                app.storage.user['last_location'] = {'name': open_weather_geocode['name'], 'lat': lat, 'lon': lon}
+                last_weather_data = {
+                    'lat': lat,
+                    'lon': lon,
+                    'geocode': open_weather_geocode,
+                    'current': current,
+                    'hourly': hourly,
+                    'daily': daily,
+                }
+                render_weather()
+                with metrics.stage('alerts'):
+                    watch_alerts(lat, lon)
+                watch_live(open_weather_geocode['name'], lat, lon)
+                background_tasks.create(tile_proxy.prefetch_neighbourhood(lat, lon), name='tile prefetch')
+                #today_weather_map.set_source(open_weather_map)
+            finally:
+                hide_loading()
+
+    #weather.gov alerts are pushed by the alerts service whenever they change for the location being shown
+    alerts_subscription = None
+    alerts_cell = None
+    def show_alerts(active_alerts):
+        alerts_column.clear()
+        with alerts_column:
+            for alert in active_alerts:
+                with ui.row().classes('items-center no-wrap'):
+                    ui.icon('warning', color='negative' if alert['severity'] in ('Extreme', 'Severe') else 'warning')
+                    ui.label(alert['headline']).tooltip(alert['event'])
+
+    def watch_alerts(lat, lon):
+        nonlocal alerts_subscription, alerts_cell
+        if alerts.ZoneCache.cell(lat, lon) == alerts_cell:
             return
-        except Exception as e:
-            print(e)
-            loading_dialog.close()
-            general_error_dialog.open()
+        alerts_cell = alerts.ZoneCache.cell(lat, lon)
+        if alerts_subscription is not None:
+            alerts.service.unsubscribe(alerts_subscription)
+            alerts_column.clear()
+        alerts_subscription = alerts.service.subscribe(lat, lon, show_alerts)
+
+    def stop_watching_alerts():
+        if alerts_subscription is not None:
+            alerts.service.unsubscribe(alerts_subscription)
+    ui.context.client.on_delete(stop_watching_alerts)
+
+    #Newer forecasts for the location being shown are pushed by the live update broadcaster, see live_updates.py
+    live_subscription = None
+    live_location = None
+    def show_live_update(page):
+        nonlocal last_weather_data
+        if last_weather_data is None:
             return
+        last_weather_data = dict(last_weather_data, current=page['current'], hourly=page['hourly'], daily=page['daily'])
+        if page['scale'] == temp_scale_selector.value:
+            apply_view(page)
+        else:
+            render_weather()
 
-        try:
-            gov_weather_alerts = get_weather.get_alerts_gov_weather(lat, lon)
-            gov_weather = get_weather.get_weather_gov_weather(lat, lon)
-            gov_county_link = gov_weather['properties']['county']
-            county_code_match = re.match(r'https://api\.weather\.gov/zones/county/(.*)/?', gov_county_link)
-            if not county_code_match:
-                print('Could not find match from county code url:', gov_county_link)
-            gov_county_code = county_code_match.group(1)
-            gov_weather_alerts_zone = get_weather.get_alerts_gov_weather_zone(gov_county_code)
-        except HTTPError as e:
-            print('Government data problem')
-            loading_dialog.close()
-            request_error_dialog.open()
+    def watch_live(name, lat, lon):
+        nonlocal live_subscription, live_location
+        if (name, lat, lon) == live_location:
             return
-        except Exception as e:
-            print(e)
-            loading_dialog.close()
-            general_error_dialog.open()
+        live_location = (name, lat, lon)
+        stop_watching_live()
+        live_subscription = live_updates.broadcaster.subscribe(
+            name, lat, lon, temp_scale_selector.value, show_live_update,
+            (last_weather_data['current'], last_weather_data['hourly'], last_weather_data['daily']))
+
+    def stop_watching_live():
+        if live_subscription is not None:
+            live_updates.broadcaster.unsubscribe(live_subscription)
+    ui.context.client.on_delete(stop_watching_live)
+
+    #Fills the page from the last fetched forecast, converting from the canonical unit to the selected one
+    def render_weather():
+        if last_weather_data is None:
             return
-        loading_dialog.close()
-        last_updated_weather_time = update_time
-        last_weather_location = Location(location_string, lat, lon)
-        last_weather_unit = temp_scale_selector.value
-        location_label.set_text(f'{open_weather_geocode["name"]} ({round(lat, 2)}' + u"\N{DEGREE SIGN}N"+ f', {round(lon, 2)}' + u"\N{DEGREE SIGN}E)")
-        today_location.set_text(open_weather_geocode['name'])
-        today_image.set_source(f'https://openweathermap.org/img/wn/{open_weather_current["weather"][0]["icon"]}@2x.png')
-        today_temp.set_text(str(round(open_weather_current['main'].get('temp', -100))) + u'\N{DEGREE SIGN}')
-        today_humidity.set_text(f"{open_weather_current['main'].get('humidity', 'NaN')}%")
-        today_feels_like.set_text(str(open_weather_current['main'].get('feels_like', 'NaN')) + u'\N{DEGREE SIGN}')
-        if 'rain' in open_weather_current:
-            today_precipitation.set_text(f'{open_weather_current["rain"].get("1h", "0")} mm')
-        else:
-            today_precipitation.set_text('0 mm')
-        timezone = datetime.timezone(datetime.timedelta(seconds=open_weather_five_day['city']['timezone']))
-        hourly_weather_rows = [{
-            'id': i,
-            'day': datetime.datetime.fromtimestamp(future_forcast.get('dt', ''), tz=timezone).strftime('%a %b %d'),
-            'time': datetime.datetime.fromtimestamp(future_forcast.get('dt', ''), tz=timezone).strftime('%I:%M%p'),
-            'temperature': str(round(future_forcast['main']['temp'])) + u'\N{DEGREE SIGN}' if 'temp' in future_forcast['main'] else 'NaN',
-            'feels_like': str(round(future_forcast['main']['feels_like'])) + u'\N{DEGREE SIGN}' if 'feels_like' in future_forcast['main'] else 'NaN',
-            'precipitation': str(round(future_forcast['pop'] * 100)) + '%' if 'pop' in future_forcast else 'NaN',
-            'weather_icon': f'https://openweathermap.org/img/wn/{future_forcast["weather"][0]["icon"]}.png',
-            'humidity': str(round(future_forcast['main']['humidity'])) + '%' if 'humidity' in future_forcast['main'] else 'NaN',
+        with metrics.stage('view'):
+            page = forecast_view.page_view(last_weather_data['geocode']['name'],
+                                           last_weather_data['lat'], last_weather_data['lon'],
+                                           last_weather_data['current'], last_weather_data['hourly'],
+                                           last_weather_data['daily'], temp_scale_selector.value)
+        with metrics.stage('push'):
+            apply_view(page)
+
+    def apply_view(page):
+        view.push('location', page['location'], location_label.set_text)
+        view.push('today_location', page['today_location'], today_location.set_text)
+        view.push('today_image', page['today_image'], today_image.set_source)
+        view.push('today_temp', page['today_temp'], today_temp.set_text)
+        view.push('today_humidity', page['today_humidity'], today_humidity.set_text)
+        view.push('today_feels_like', page['today_feels_like'], today_feels_like.set_text)
+        view.push('today_precipitation', page['today_precipitation'], today_precipitation.set_text)
+        view.push('hourly_rows', page['hourly_rows'], hourly_weather_table.update_rows)
+        for i, (card, md_weather_card) in enumerate(zip(page['daily_cards'], multi_day_weather_cards)):
+            view.push_fields(('daily_card', i), card, md_weather_card.update)
+        #The map only depends on the tile its centre snaps to
+        def show_map(centre):
+            with metrics.stage('map'):
+                today_weather_map.set_content(mapping.map_iframe_template(page['lat'], page['lon']))
+        view.push('map', page['map_centre'], show_map)
+
+    #Starts the page from the forecast cache when it holds every forecast for this visitor's own last location, so the
+    #page has content on first paint. Returns False when it does not.
+    def prerender_weather():
+        nonlocal last_weather_location, last_weather_data
+        last_location = app.storage.user.get('last_location')
+        if not last_location:
+            last_location = ip_location.local_lookup(ip_location.client_ip(request))
+            if last_location:
+                name = ', '.join(part for part in (last_location['city'], last_location['region']) if part)
+                last_location = dict(last_location, name=name)
+        if not last_location or last_location.get('lat') is None or last_location.get('lon') is None:
+            return False
+        (name, lat, lon) = (last_location['name'], last_location['lat'], last_location['lon'])
+        forecasts = async_weather.cached_forecasts(lat, lon)
+        if forecasts is None:
+            return False
+        (current, hourly, daily) = forecasts
+        last_weather_location = Location('', lat, lon)
+        last_weather_data = {
+            'lat': lat,
+            'lon': lon,
+            'geocode': {'name': name, 'lat': lat, 'lon': lon},
+            'current': current,
+            'hourly': hourly,
+            'daily': daily,
         }
-           for i, future_forcast in zip(range(len(open_weather_five_day['list'])), open_weather_five_day['list'])]
-        hourly_weather_table.clear()
-        hourly_weather_table.update_rows(hourly_weather_rows)
-        num_days = len(open_meteo_weather['Daily']['Dates'])
-        for i, md_weather_card, in zip(range(num_days), multi_day_weather_cards):
-            weather_date = open_meteo_weather['Daily']['Dates'][i].astimezone(timezone)
-            md_weather_card.update(date=weather_date.strftime('%a %m/%d'),
-                                   high=str(round(open_meteo_weather['Daily']['Max Temperature'][i])) + '\N{DEGREE SIGN}',
-                                   low=str(round(open_meteo_weather['Daily']['Min Temperature'][i])) + '\N{DEGREE SIGN}',
-                                   precipitation=str(round(open_meteo_weather['Daily']['Min Temperature'][i])) + '%',
-                                   icon=f'img:weather_icons/{get_weather.weather_code_icon_dict[open_meteo_weather["Daily"]["Weather Code"][i]]}.svg')
-
+        render_weather()
+        watch_alerts(lat, lon)
+        watch_live(name, lat, lon)
+        return True
+
+    #After a prerendered first paint, goes through the forecast cache once the client is connected. Parts that are
+    #still fresh come straight from the cache, so only stale ones reach a provider.
+    async def revalidate_weather():
+        nonlocal last_weather_data
+        weather_data = last_weather_data
+        try:
+            (current, hourly, daily) = await async_weather.get_forecasts(weather_data['lat'], weather_data['lon'])
+        except Exception as e:
+            print('Revalidation problem:', e)
+            return
+        if last_weather_data is not weather_data:
+            #The user moved on to another location meanwhile
+            return
+        if (current, hourly, daily) != (weather_data['current'], weather_data['hourly'], weather_data['daily']):
+            last_weather_data = dict(weather_data, current=current, hourly=hourly, daily=daily)
+            render_weather()
 
 
         # for future_forcast, hourly_weather_card in zip(open_weather_five_day['list'], hourly_weather_cards):
@@ -387,11 +609,12 @@ async def weather_page():
         #                                temperature=future_forcast['main']['temp'],
         #                                feels_like=future_forcast['main']['feels_like'],
         #                                precipitation=future_forcast['pop'])
-        today_weather_map.set_content(mapping.map_iframe(lat, lon))
-        #today_weather_map.set_source(open_weather_map)
         # for (daily_weather, daily_weather_card) in zip(new_weather.daily_forecasts, multi_day_weather_cards):
         #     daily_weather_card.update(date=daily_weather.date, high=daily_weather.highest_temperature, low=daily_weather.lowest_temperature)
-    await weather_from_rough_location()
+    if prerender_weather():
+        ui.timer(0, revalidate_weather, once=True)
+    else:
+        await weather_from_rough_location()
     # with ui.table(title='Ten Day Forcast',
     #               columns=[{'name': 'day', 'label': '', 'field': 'day'},
     #                        {'name': 'weather', 'label': '', 'field': 'weather'}],
@@ -399,7 +622,9 @@ async def weather_page():
     #    pass
 
 if __name__ in {"__main__", "__mp_main__"}:
-    ui.run(storage_secret='0')
+    #With reload on, the app is imported twice, once by the file watcher and once by the worker. Set RELOAD=0 in
+    #production so every worker start pays for one import. workers.py starts several, each on its own PORT.
+    ui.run(storage_secret='0', reload=os.environ.get('RELOAD', '1') == '1', port=int(os.environ.get('PORT', 8080)))
 
 
 
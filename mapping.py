@@ -1,22 +1,115 @@
-import folium
-from get_weather import open_weather_api_key
+import functools
+import html
+import string
+import get_weather
 
-def map_iframe(lat, lon, zoom=7):
-    map = folium.Map((lat, lon), min_zoom=7, max_zoom=7,
+#The map only depends on its centre, and it is locked at one zoom level. Locations are snapped to the centre of the
+#map tile they fall in, so everyone in the same tile shares one rendered fragment.
+map_zoom = 7
+
+#Overlay layers as (OpenWeather layer, display name, shown by default)
+weather_layers = [
+    ('clouds_new', 'Clouds', True),
+    ('precipitation_new', 'Precipitation', True),
+    ('pressure_new', 'Pressure', False),
+    ('wind_new', 'Wind', False),
+    ('temp_new', 'Temperature', False),
+]
+
+
+#Overlay tiles are served through tile_proxy, which keeps the API key on the server and caches tiles for everyone.
+#Set to '' to have browsers load tiles from OpenWeather directly.
+tile_proxy_prefix = '/tiles'
+
+
+def weather_layer_url(layer):
+    if tile_proxy_prefix:
+        return f'{tile_proxy_prefix}/{layer}/{{z}}/{{x}}/{{y}}.png'
+    api_key = get_weather.get_open_weather_api_key()
+    return f'{get_weather.open_weather_tile_url}/map/{layer}/{{z}}/{{x}}/{{y}}.png?appid={api_key}'
+
+
+#Centre (lat, lon) of the map tile the location falls in
+def snap_to_tile_centre(lat, lon, zoom=map_zoom):
+    (tile_x, tile_y) = get_weather.tile_coordinates(lat, lon, zoom)
+    world_tile_size = 256 / 2 ** zoom
+    return get_weather.inverse_mercator_projection((tile_x + 0.5) * world_tile_size, (tile_y + 0.5) * world_tile_size)
+
+
+def map_iframe(lat, lon, zoom=map_zoom):
+    return _folium_map_iframe(*snap_to_tile_centre(lat, lon, zoom), zoom)
+
+
+@functools.lru_cache(maxsize=1024)
+def _folium_map_iframe(lat, lon, zoom):
+    import folium
+    map = folium.Map((lat, lon), zoom_start=zoom, min_zoom=zoom, max_zoom=zoom,
                      zoom_control=False, dragging=False, doubleClickZoom=False, boxZoom=False, scrollWheelZoom=False,
                      keyboard=False, touchZoom=False)
     #map.get_root().width = "200px"
     #map.get_root().height = "200px"
-    folium.TileLayer('https://tile.openweathermap.org/map/clouds_new/{z}/{x}/{y}.png?appid='+ open_weather_api_key,
-                     name='Clouds', attr='Weather data provided by OpenWeather', overlay=True, show=True).add_to(map)
-    folium.TileLayer('https://tile.openweathermap.org/map/precipitation_new/{z}/{x}/{y}.png?appid='+ open_weather_api_key,
-                     name='Precipitation', attr='Weather data provided by OpenWeather', overlay=True, show=True).add_to(map)
-    folium.TileLayer('https://tile.openweathermap.org/map/pressure_new/{z}/{x}/{y}.png?appid='+ open_weather_api_key,
-                     name='Pressure', attr='Weather data provided by OpenWeather', overlay=True, show=False).add_to(map)
-    folium.TileLayer('https://tile.openweathermap.org/map/wind_new/{z}/{x}/{y}.png?appid='+ open_weather_api_key,
-                     name='Wind', attr='Weather data provided by OpenWeather', overlay=True, show=False).add_to(map)
-    folium.TileLayer('https://tile.openweathermap.org/map/temp_new/{z}/{x}/{y}.png?appid='+ open_weather_api_key,
-                     name='Temperature', attr='Weather data provided by OpenWeather', overlay=True, show=False).add_to(map)
+    for (layer, name, show) in weather_layers:
+        folium.TileLayer(weather_layer_url(layer),
+                         name=name, attr='Weather data provided by OpenWeather', overlay=True, show=show).add_to(map)
     folium.LayerControl().add_to(map)
     iframe = map.get_root()._repr_html_()
     return iframe
+
+
+#Same map as map_iframe without folium: the fixed layer set is written out once as plain Leaflet and only the
+#centre is substituted per location
+_map_document = string.Template('''<!DOCTYPE html>
+<html>
+<head>
+    <meta http-equiv="content-type" content="text/html; charset=UTF-8" />
+    <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no" />
+    <script src="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js"></script>
+    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css"/>
+    <style>
+        html, body { width: 100%; height: 100%; margin: 0; padding: 0; }
+        #map { position: absolute; top: 0; bottom: 0; right: 0; left: 0; }
+        .leaflet-container { font-size: 1rem; }
+    </style>
+</head>
+<body>
+    <div id="map"></div>
+    <script>
+        var map = L.map('map', {
+            center: [$lat, $lon], zoom: $zoom, minZoom: $zoom, maxZoom: $zoom, zoomControl: false, dragging: false,
+            doubleClickZoom: false, boxZoom: false, scrollWheelZoom: false, keyboard: false, touchZoom: false
+        });
+        var base_layer = L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {
+            attribution: '&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
+        }).addTo(map);
+        var overlays = {};
+        $overlays
+        L.control.layers({'openstreetmap': base_layer}, overlays, {position: 'topright', collapsed: true}).addTo(map);
+    </script>
+</body>
+</html>''')
+_overlay_template = ("overlays[{name!r}] = L.tileLayer({url!r}, "
+                     "{{attribution: 'Weather data provided by OpenWeather'}});{add}")
+_iframe_template = ('<div style="width:100%;"><div style="position:relative;width:100%;height:0;padding-bottom:60%;">'
+                    '<iframe srcdoc="{document}" style="position:absolute;width:100%;height:100%;left:0;top:0;'
+                    'border:none !important;" allowfullscreen webkitallowfullscreen mozallowfullscreen></iframe>'
+                    '</div></div>')
+
+
+@functools.lru_cache(maxsize=1)
+def _prebuilt_map_iframe():
+    overlays = '\n        '.join(
+        _overlay_template.format(name=name, url=weather_layer_url(layer),
+                                 add=f' overlays[{name!r}].addTo(map);' if show else '')
+        for (layer, name, show) in weather_layers)
+    document = _map_document.safe_substitute(overlays=overlays)
+    #Escaped once here; the placeholders left for the centre contain nothing that needs escaping
+    return string.Template(_iframe_template.format(document=html.escape(document, quote=True)))
+
+
+def map_iframe_template(lat, lon, zoom=map_zoom):
+    return _template_map_iframe(*snap_to_tile_centre(lat, lon, zoom), zoom)
+
+
+@functools.lru_cache(maxsize=1024)
+def _template_map_iframe(lat, lon, zoom):
+    return _prebuilt_map_iframe().substitute(lat=round(lat, 6), lon=round(lon, 6), zoom=zoom)
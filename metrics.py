@@ -0,0 +1,301 @@
+import bisect
+import contextvars
+import functools
+import json
+import math
+import os
+import random
+import threading
+import time
+import forecast_cache
+
+#Timings of weather updates, their stages and every upstream call, for telling which part of a slow refresh was slow.
+#Everything goes into fixed bucket histograms and counters rendered in the Prometheus text format, see render().
+#A sampled share of traced requests is also written out in full, one JSON line per request with each stage and
+#upstream call it made, its cache hits and misses and the bytes it received.
+#Recording is a perf_counter pair, a bisect and a locked list increment, a few microseconds per stage against the
+#milliseconds even a fully cached update takes, and unsampled requests keep no spans.
+
+#Fraction of traced requests written to the trace log, 0 to turn it off
+trace_sample_rate = float(os.environ.get('METRICS_TRACE_SAMPLE', 0))
+#JSON lines file the sampled traces are appended to, printed when empty
+trace_log_path = os.environ.get('METRICS_TRACE_LOG', '')
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+#Histogram bucket upper bounds, in seconds and bytes
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+size_buckets = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+#Name of the get_weather call running in this context, for labelling the HTTP responses it receives
+_current_call = contextvars.ContextVar('call', default='')
+_trace_log_lock = threading.Lock()
+
+
+def _label_text(label_names, label_values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for (name, value) in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram():
+    def __init__(self, name, help, label_names=(), buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        #label values -> [per bucket counts, the last one past every bucket, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = [(label_values, list(counts), total) for (label_values, (counts, total)) in self._series.items()]
+        for (label_values, counts, total) in sorted(series):
+            cumulative = 0
+            for (bound, count) in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                labels = _label_text(self.label_names, label_values, f'le="{_number(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _label_text(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {_number(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Counter():
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        for (label_values, value) in values:
+            lines.append(f'{self.name}{_label_text(self.label_names, label_values)} {_number(value)}')
+        return lines
+
+
+request_seconds = Histogram('weather_request_seconds', 'Time to serve a traced request, e.g. a weather update',
+                            ('request', 'outcome'))
+stage_seconds = Histogram('weather_stage_seconds', 'Time spent in each stage of a traced request',
+                          ('request', 'stage'))
+call_seconds = Histogram('weather_call_seconds', 'Time of each get_weather call that went upstream',
+                         ('call', 'outcome'))
+response_bytes = Histogram('weather_upstream_response_bytes', 'Size of upstream HTTP responses',
+                           ('provider', 'call', 'cache'), size_buckets)
+forecast_lookups = Counter('weather_forecast_cache_lookups_total', 'Forecast cache lookups by result',
+                           ('data_type', 'result'))
+registry = [request_seconds, stage_seconds, call_seconds, response_bytes, forecast_lookups]
+#name -> function returning a stats dict, exported as gauges, e.g. {'forecast_cache': default_cache.stats}
+collectors = {}
+
+
+#One traced request. Always feeds the request and stage histograms; sampled ones also keep their spans for the log.
+class Trace():
+    __slots__ = ('name', 'outcome', 'attributes', 'spans', 'start', 'wall_start', '_token')
+
+    def __init__(self, name, sampled):
+        self.name = name
+        self.outcome = 'ok'
+        self.attributes = {}
+        self.spans = [] if sampled else None
+
+    def __enter__(self):
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self._token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self.start
+        _current_trace.reset(self._token)
+        if exc_type is not None and self.outcome == 'ok':
+            self.outcome = 'error'
+        request_seconds.observe(seconds, self.name, self.outcome)
+        if self.spans is not None:
+            _write_trace({'request': self.name, 'time': self.wall_start, 'seconds': round(seconds, 6),
+                          'outcome': self.outcome, **self.attributes, 'spans': self.spans})
+        return False
+
+    #May be called from worker threads, which get a copy of the request's context
+    def span(self, name, start, seconds, **attributes):
+        if self.spans is not None:
+            self.spans.append({'name': name, 'offset': round(start - self.start, 6), 'seconds': round(seconds, 6),
+                               **attributes})
+
+
+def _write_trace(record):
+    line = json.dumps(record, default=str)
+    if not trace_log_path:
+        print('Trace:', line)
+        return
+    with _trace_log_lock:
+        with open(trace_log_path, 'a', encoding='utf-8') as trace_log:
+            trace_log.write(line + '\n')
+
+
+#Context manager timing a whole request, sampled into the trace log at trace_sample_rate
+def trace(name):
+    return Trace(name, trace_sample_rate > 0 and random.random() < trace_sample_rate)
+
+
+#Sets the outcome label, and on sampled traces extra fields, of the request being traced
+def annotate(outcome=None, **attributes):
+    current = _current_trace.get()
+    if current is None:
+        return
+    if outcome is not None:
+        current.outcome = outcome
+    if current.spans is not None:
+        current.attributes.update(attributes)
+
+
+class Stage():
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self.start
+        current = _current_trace.get()
+        stage_seconds.observe(seconds, current.name if current is not None else '', self.name)
+        if current is not None and current.spans is not None:
+            current.span(self.name, self.start, seconds, **({'error': exc_type.__name__} if exc_type else {}))
+        return False
+
+
+#Context manager timing one stage of the request being traced, e.g. with metrics.stage('geocode'):
+def stage(name):
+    return Stage(name)
+
+
+#Decorator timing a blocking upstream call, e.g. a get_weather function. HTTP responses received during the call are
+#labelled with its name.
+def traced(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current_call.set(name)
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            _current_call.reset(token)
+            call_seconds.observe(seconds, name, outcome)
+            current = _current_trace.get()
+            if current is not None and current.spans is not None:
+                current.span(name, start, seconds, outcome=outcome)
+    return wrapper
+
+
+#requests response hook for a provider's session, recording the size of every response and, on sessions with a
+#requests_cache backend, whether the cache answered it
+def response_hook(provider, cached=False):
+    def record(response, *args, **kwargs):
+        from_cache = getattr(response, 'from_cache', False)
+        if not from_cache:
+            #A requests_cache session dispatches hooks a second time for the responses it fetched
+            if getattr(response, '_metrics_recorded', False):
+                return response
+            try:
+                response._metrics_recorded = True
+            except AttributeError:
+                pass
+        cache = ('hit' if from_cache else 'miss') if cached else 'none'
+        size = int(response.headers.get('Content-Length') or len(response.content))
+        call = _current_call.get()
+        response_bytes.observe(size, provider, call, cache)
+        current = _current_trace.get()
+        if current is not None and current.spans is not None:
+            seconds = 0.0 if from_cache else response.elapsed.total_seconds()
+            current.span('http', time.perf_counter() - seconds, seconds, provider=provider, call=call, cache=cache,
+                         status=response.status_code, bytes=size)
+        return response
+    return record
+
+
+def _record_forecast_lookup(key, result):
+    forecast_lookups.inc(key[0], result)
+    current = _current_trace.get()
+    if current is not None and current.spans is not None:
+        current.span('forecast_cache', time.perf_counter(), 0.0, data_type=key[0], result=result)
+
+
+forecast_cache.lookup_listeners.append(_record_forecast_lookup)
+
+
+#Numeric leaves of a stats dict as (name, labels, value). A dict of dicts, e.g. one per provider, is labelled by key.
+def _stat_samples(name, value, labels=()):
+    if isinstance(value, bool):
+        yield (name, labels, int(value))
+    elif isinstance(value, (int, float)):
+        yield (name, labels, value)
+    elif isinstance(value, dict):
+        for (key, inner) in value.items():
+            if isinstance(inner, dict) and inner and all(isinstance(group, dict) for group in inner.values()):
+                for (group_key, group) in inner.items():
+                    yield from _stat_samples(f'{name}_{key}', group, labels + (('key', group_key),))
+            else:
+                yield from _stat_samples(f'{name}_{key}', inner, labels)
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    #Samples of one gauge are grouped under a single TYPE line, as the format requires
+    gauges = {}
+    for (collector_name, collector) in collectors.items():
+        try:
+            samples = list(_stat_samples('weather_' + collector_name, collector()))
+        except Exception as e:
+            print('Metrics collector problem:', collector_name, e)
+            continue
+        for (name, labels, value) in samples:
+            if not (isinstance(value, float) and math.isnan(value)):
+                gauges.setdefault(name, []).append(
+                    f'{name}{_label_text([label for (label, _) in labels], [v for (_, v) in labels])} {_number(value)}')
+    for (name, samples) in gauges.items():
+        lines.append(f'# TYPE {name} gauge')
+        lines += samples
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,175 @@
+import asyncio
+import collections
+import threading
+import time
+import forecast_cache
+
+#Routes a request over providers that can stand in for each other. Every upstream fetch feeds a latency window and a
+#circuit breaker per provider. The first provider whose breaker lets requests through is called, and if it has not
+#answered within its own p95 latency the next one is called as a hedge; the first success wins. When every provider
+#fails, or none has answered within request_timeout, the caller's fallback, normally a stale cached value, is used.
+
+#Hedges never go out sooner than this many seconds, nor later than hedge_max_delay
+hedge_min_delay = 0.25
+hedge_max_delay = 2.0
+#Hedge delay while a provider has too few latency samples for a percentile
+hedge_default_delay = 1.0
+#Seconds, like the upstream requests' own timeout, a fetch waits for its providers before using the fallback. Without
+#a fallback value it keeps waiting for them to answer or fail.
+request_timeout = 3.0
+latency_window = 256
+min_latency_samples = 20
+#Consecutive failures that open a provider's breaker, and seconds it stays open before a trial request
+breaker_failure_threshold = 3
+breaker_open_seconds = 30
+
+
+class LatencyTracker():
+    def __init__(self, window=latency_window):
+        self.samples = collections.deque(maxlen=window)
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    #Latency at quantile q (0-1) over the window, or None without enough samples
+    def percentile(self, q):
+        samples = sorted(self.samples)
+        if len(samples) < min_latency_samples:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+#Closed: requests flow. Open: requests are refused until breaker_open_seconds have passed. Half open: one trial
+#request is let through, and its outcome closes or reopens the breaker. A trial without an outcome, e.g. one cancelled
+#by a hedge, is given up after another breaker_open_seconds and a new one let through.
+class CircuitBreaker():
+    def __init__(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state != 'closed' and time.monotonic() - self.opened_at >= breaker_open_seconds:
+                self.state = 'half_open'
+                self.opened_at = time.monotonic()
+                return True
+            return self.state == 'closed'
+
+    #Outcome of a call let through while half open, including calls the forecast cache answered without an upstream
+    #fetch, which the fetch listener never hears about
+    def record_trial(self, success):
+        if self.state != 'half_open':
+            return
+        if success:
+            self.record_success()
+        else:
+            self.record_failure()
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= breaker_failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+class ProviderRouter():
+    def __init__(self):
+        self.latencies = collections.defaultdict(LatencyTracker)
+        self.breakers = collections.defaultdict(CircuitBreaker)
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+
+    #Fetch listener for forecast_cache
+    def record(self, provider, seconds, error):
+        if error is None:
+            self.latencies[provider].record(seconds)
+            self.breakers[provider].record_success()
+        else:
+            self.breakers[provider].record_failure()
+
+    def hedge_delay(self, provider):
+        p95 = self.latencies[provider].percentile(0.95)
+        if p95 is None:
+            return hedge_default_delay
+        return min(max(p95, hedge_min_delay), hedge_max_delay)
+
+    #sources is a list of (provider, coroutine function) in order of preference, fallback a function returning a
+    #value or None. Returns the first successful result, else the fallback's value, else raises the first error.
+    async def fetch(self, sources, fallback=None):
+        candidates = [(provider, call) for (provider, call) in sources if self.breakers[provider].allow()]
+        if not candidates:
+            value = self._fallback(fallback)
+            if value is not None:
+                return value
+            #Nothing cached either, so try the preferred provider even though its breaker is open
+            candidates = sources[:1]
+        errors = []
+        pending = {}
+        started = time.monotonic()
+        try:
+            for (i, (provider, call)) in enumerate(candidates):
+                pending[asyncio.ensure_future(call())] = i
+                is_last = i == len(candidates) - 1
+                deadline = time.monotonic() + self.hedge_delay(provider)
+                if is_last:
+                    deadline = max(deadline, started + request_timeout)
+                while pending:
+                    timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                    (done, waiting) = await asyncio.wait(pending, timeout=timeout,
+                                                         return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        index = pending.pop(task)
+                        self.breakers[candidates[index][0]].record_trial(task.exception() is None)
+                        if task.exception() is None:
+                            if index > 0:
+                                self.hedge_wins += 1
+                            return task.result()
+                        errors.append(task.exception())
+                    if not done and not is_last:
+                        #Too slow, hedge with the next provider while this one keeps going
+                        self.hedges += 1
+                        break
+                    if not done:
+                        #Nobody left to hedge with and past the request timeout, so a cached value beats waiting
+                        deadline = None
+                        value = self._fallback(fallback)
+                        if value is not None:
+                            return value
+                    if not pending and not is_last:
+                        #Failed outright, move straight on to the next provider
+                        break
+        finally:
+            #Upstream calls are coalesced and shielded, so cancelling here never cuts off a fetch other callers share
+            for task in pending:
+                task.cancel()
+        value = self._fallback(fallback)
+        if value is not None:
+            return value
+        if errors:
+            raise errors[0]
+        raise RuntimeError('No provider available')
+
+    def _fallback(self, fallback):
+        value = fallback() if fallback is not None else None
+        if value is not None:
+            self.fallbacks += 1
+        return value
+
+    def stats(self):
+        return {'hedges': self.hedges, 'hedge_wins': self.hedge_wins, 'fallbacks': self.fallbacks,
+                'providers': {provider: {'state': self.breakers[provider].state,
+                                         'p95': self.latencies[provider].percentile(0.95)}
+                              for provider in set(self.latencies) | set(self.breakers)}}
+
+
+router = ProviderRouter()
+forecast_cache.fetch_listeners.append(router.record)
@@ -0,0 +1,48 @@
+#Keeps the view-model last pushed to one client's page, so a render only touches the elements whose value changed.
+#Each element update is sent over the websocket in full, so skipping unchanged elements is what saves the traffic
+#and the browser re-render on a refresh where little has changed.
+
+#Element updates sent and skipped as unchanged, over every page
+pushed = 0
+skipped = 0
+
+
+class PushedView():
+    _missing = object()
+
+    def __init__(self):
+        self._values = {}
+
+    #Calls apply(value) when value differs from what was last pushed under key. Returns whether it did.
+    def push(self, key, value, apply):
+        global pushed, skipped
+        previous = self._values.get(key, self._missing)
+        #Shared view-models are usually the very same object as last time, which makes the check free
+        if previous is value or (previous is not self._missing and previous == value):
+            skipped += 1
+            return False
+        self._values[key] = value
+        apply(value)
+        pushed += 1
+        return True
+
+    #For a dict of fields, calls apply(**changed_fields) with only the fields that differ from the last push
+    def push_fields(self, key, fields, apply):
+        global pushed, skipped
+        previous = self._values.get(key, {})
+        if previous is fields:
+            skipped += 1
+            return False
+        changed = {name: value for (name, value) in fields.items()
+                   if name not in previous or previous[name] != value}
+        self._values[key] = fields
+        if not changed:
+            skipped += 1
+            return False
+        apply(**changed)
+        pushed += 1
+        return True
+
+
+def stats():
+    return {'pushed': pushed, 'skipped': skipped}
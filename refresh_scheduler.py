@@ -0,0 +1,224 @@
+import asyncio
+import csv
+import os
+import threading
+import time
+import async_weather
+import forecast_cache
+import get_weather
+import units
+
+#Keeps popular forecasts warm. Every forecast cache lookup counts towards its location's popularity, the most
+#requested locations are refreshed shortly before their entries expire, and stale entries that were served to a user
+#are revalidated in the background. Upstream calls made here are limited by a per-provider rate budget.
+#Optionally, the daily forecasts of a list of places are fetched at startup, many locations per request.
+
+#Requests per minute each provider may spend on background refreshes
+provider_rate_budgets = {'open_weather': 30, 'open_meteo': 60}
+#How many of the most requested locations are kept warm
+top_n = 50
+#Seconds between sweeps over the popular locations
+sweep_interval = 30
+#Popular entries are refreshed once less than this fraction of their TTL is left
+refresh_ahead = 0.2
+#Popularity counts are multiplied by this every sweep so old traffic fades out
+popularity_decay = 0.5
+#Keys of providers with a batch endpoint are refreshed together, this many per upstream request
+batch_size = 100
+#CSV with lat and lon columns, e.g. the most searched places, whose daily forecasts are fetched at startup.
+#A gazetteer CSV works too.
+warm_locations_path = os.environ.get('FORECAST_WARM_CSV', '')
+#Seconds between purges of old entries from the forecast cache's disk tier, the first one at startup
+purge_interval = 60 * 60
+
+
+#Token bucket allowing per_minute calls per minute. Sweeps spend it every sweep_interval, so it holds a whole
+#interval's worth; a smaller bucket would overflow between sweeps and the budget would never be reached.
+class RateBudget():
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = max(per_minute * sweep_interval / 60, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def try_acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RefreshScheduler():
+    def __init__(self, cache=None, refresh=None, refresh_many=None):
+        self.cache = cache or forecast_cache.default_cache
+        #Coroutine functions that refresh a cache key and a list of keys
+        self.refresh = refresh or async_weather.refresh_forecast
+        self.refresh_many = refresh_many or async_weather.refresh_forecasts
+        self.budgets = {provider: RateBudget(per_minute) for (provider, per_minute) in provider_rate_budgets.items()}
+        self.popularity = {}
+        self.refreshed = 0
+        self.revalidated = 0
+        self.skipped_for_budget = 0
+        self.disk_entries = 0
+        self._pending = set()
+        self._in_progress = set()
+        self._tasks = set()
+        self._lock = threading.Lock()
+        self._wake = None
+        self._loop = None
+        self._task = None
+
+    #Access listener, may be called from worker threads
+    def record(self, key):
+        with self._lock:
+            self.popularity[key] = self.popularity.get(key, 0) + 1
+
+    #Stale listener, may be called from worker threads
+    def request_revalidation(self, key):
+        with self._lock:
+            self._pending.add(key)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def start(self):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            forecast_cache.access_listeners.append(self.record)
+            forecast_cache.stale_listeners.append(self.request_revalidation)
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            forecast_cache.access_listeners.remove(self.record)
+            forecast_cache.stale_listeners.remove(self.request_revalidation)
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        next_sweep = time.monotonic() + sweep_interval
+        next_purge = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(),
+                                       timeout=max(min(next_sweep, next_purge) - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                self._revalidate_pending()
+                if time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + sweep_interval
+                    self._sweep()
+                if time.monotonic() >= next_purge:
+                    next_purge = time.monotonic() + purge_interval
+                    self.disk_entries = await asyncio.to_thread(self.cache.purge_disk)
+            except Exception as e:
+                print('Refresh scheduler problem:', e)
+
+    def _revalidate_pending(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = set()
+        self.revalidated += self._schedule_refreshes(pending)
+
+    #Refreshes the most popular entries that are about to expire
+    def _sweep(self):
+        with self._lock:
+            popular = sorted(self.popularity.items(), key=lambda item: item[1], reverse=True)[:top_n]
+            self.popularity = {key: count * popularity_decay for (key, count) in self.popularity.items()
+                               if count * popularity_decay >= 0.1}
+        now = time.time()
+        due = []
+        for (key, count) in popular:
+            expires = self.cache.expires(key)
+            if expires is not None and expires - now < self.cache.ttls[key[0]] * refresh_ahead:
+                due.append(key)
+        self.refreshed += self._schedule_refreshes(due)
+
+    #Schedules refreshes for keys, batching the data types that have a batch provider. Returns how many were scheduled.
+    def _schedule_refreshes(self, keys):
+        scheduled = 0
+        groups = {}
+        for key in keys:
+            if key in self._in_progress:
+                continue
+            if key[0] in forecast_cache.batch_providers:
+                groups.setdefault((key[0], key[3]), []).append(key)
+            elif self._schedule_refresh(key):
+                scheduled += 1
+        for group in groups.values():
+            for start in range(0, len(group), batch_size):
+                chunk = group[start:start + batch_size]
+                if self._spend_budget(chunk[0], len(chunk)):
+                    self._start(self._refresh_many(chunk), chunk)
+                    scheduled += len(chunk)
+        return scheduled
+
+    def _spend_budget(self, key, count=1):
+        budget = self.budgets.get(forecast_cache.providers[key[0]][1])
+        if budget is not None and not budget.try_acquire():
+            self.skipped_for_budget += count
+            return False
+        return True
+
+    def _start(self, coroutine, keys):
+        self._in_progress.update(keys)
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _schedule_refresh(self, key):
+        if key in self._in_progress or not self._spend_budget(key):
+            return False
+        self._start(self._refresh(key), [key])
+        return True
+
+    async def _refresh(self, key):
+        try:
+            await self.refresh(key)
+        except Exception as e:
+            print('Background refresh failed for', key, e)
+        finally:
+            self._in_progress.discard(key)
+
+    async def _refresh_many(self, keys):
+        try:
+            await self.refresh_many(keys)
+        except Exception as e:
+            print('Background refresh failed for', len(keys), 'keys', e)
+        finally:
+            self._in_progress.difference_update(keys)
+
+    def stats(self):
+        return {'tracked': len(self.popularity), 'refreshed': self.refreshed, 'revalidated': self.revalidated,
+                'skipped_for_budget': self.skipped_for_budget, 'in_progress': len(self._in_progress),
+                'disk_entries': self.disk_entries}
+
+
+def read_warm_locations(path):
+    with open(path, newline='', encoding='utf-8') as csv_file:
+        return [(float(row['lat']), float(row['lon'])) for row in csv.DictReader(csv_file)]
+
+
+#Fills the forecast cache with the daily forecasts of the places in warm_locations_path through the batch provider,
+#so warming hundreds of locations takes a handful of requests. Returns the number of grid cells fetched.
+async def warm_up(path=None):
+    path = path or warm_locations_path
+    if not path:
+        return 0
+    try:
+        coordinates = await asyncio.to_thread(read_warm_locations, path)
+        count = await async_weather.warm_forecasts('daily', coordinates,
+                                                   get_weather.open_meteo_units[units.canonical_scale])
+    except Exception as e:
+        print('Forecast warm-up problem:', e)
+        return 0
+    print(f'Warmed {count} daily forecasts from {path}')
+    return count
+
+
+scheduler = RefreshScheduler()
@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import time
+import uuid
+
+#SQLite settings for cache files that several worker processes on one host use at once, and leases that let one of
+#them fetch a key while the others wait for its result. Write-ahead logging lets readers carry on while another
+#process writes, every write is a single atomic statement, and the file is memory mapped so reads of hot pages skip
+#the read() system call.
+
+#Bytes of each cache file mapped into memory
+mmap_size = int(os.environ.get('SHARED_CACHE_MMAP_BYTES', 256 * 1024 * 1024))
+#Milliseconds a write waits for another process's write to finish
+busy_timeout = 5000
+#Seconds a lease is held at most, in case its worker dies mid fetch
+lease_seconds = 15
+#Seconds between checks while waiting on another worker's lease
+lease_poll_interval = 0.05
+#Identifies this process as a lease owner. The random part keeps a recycled pid from inheriting a dead worker's leases.
+owner = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+def connect(path):
+    connection = sqlite3.connect(path, check_same_thread=False, timeout=busy_timeout / 1000)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute(f'PRAGMA mmap_size={mmap_size}')
+    connection.execute(f'PRAGMA busy_timeout={busy_timeout}')
+    return connection
+
+
+#Cross-process single flight over a table in a shared SQLite file. Only the process holding a key's lease fetches it;
+#the others wait for the value to show up in the shared cache.
+class Leases():
+    #connection and lock are the cache's own, as a sqlite3 connection must not be used by two threads at once
+    def __init__(self, connection, lock):
+        self._connection = connection
+        self._lock = lock
+        with self._lock:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS leases '
+                                     '(key TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+            self._connection.commit()
+        self.acquired = 0
+        self.waited = 0
+
+    #True when this process now holds the lease, False while another live process does
+    def acquire(self, key, seconds=lease_seconds, now=None):
+        now = now or time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                'INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, '
+                'expires = excluded.expires WHERE leases.expires < ? OR leases.owner = excluded.owner',
+                (key, owner, now + seconds, now))
+            self._connection.commit()
+        if cursor.rowcount == 1:
+            self.acquired += 1
+            return True
+        return False
+
+    def release(self, key):
+        with self._lock:
+            self._connection.execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, owner))
+            self._connection.commit()
+
+    def held(self, key, now=None):
+        with self._lock:
+            row = self._connection.execute('SELECT expires FROM leases WHERE key = ?', (key,)).fetchone()
+        return row is not None and row[0] >= (now or time.time())
+
+    #Blocks until find() returns something or the lease on key is gone, checking every lease_poll_interval. Returns
+    #what find() returned, None when the lease holder gave up or died without a result.
+    def wait(self, key, find, timeout=lease_seconds):
+        self.waited += 1
+        deadline = time.monotonic() + timeout
+        while True:
+            found = find()
+            if found is not None:
+                return found
+            if not self.held(key) or time.monotonic() > deadline:
+                #The holder may have stored its result just before letting go
+                return find()
+            time.sleep(lease_poll_interval)
+
+    def purge_expired(self, now=None):
+        with self._lock:
+            self._connection.execute('DELETE FROM leases WHERE expires < ?', (now or time.time(),))
+            self._connection.commit()
+
+    def stats(self):
+        return {'acquired': self.acquired, 'waited': self.waited}
+
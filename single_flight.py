@@ -0,0 +1,33 @@
+import asyncio
+
+#Request coalescing. While a call for a key is running, later callers for the same key await the same result
+#instead of starting their own.
+
+
+class SingleFlight():
+    def __init__(self):
+        self.calls = 0
+        self.deduplicated = 0
+        self._in_flight = {}
+
+    async def do(self, key, coroutine_function, *args, **kwargs):
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.deduplicated += 1
+        else:
+            self.calls += 1
+            future = asyncio.ensure_future(coroutine_function(*args, **kwargs))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        #Shielded so one caller going away does not cancel the call for everyone else
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+        #Marks the error as seen, in case every caller went away before the call finished
+        if not future.cancelled():
+            future.exception()
+
+    def stats(self):
+        return {'calls': self.calls, 'deduplicated': self.deduplicated, 'in_flight': len(self._in_flight)}
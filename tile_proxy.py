@@ -0,0 +1,185 @@
+import asyncio
+import collections
+import os
+import threading
+import time
+from fastapi import HTTPException, Response
+from nicegui import app
+import get_weather
+import http_sessions
+import mapping
+import single_flight
+
+#Caching proxy for the OpenWeather map overlays. Browsers load tiles from /tiles/{layer}/{z}/{x}/{y}.png, so the API
+#key never leaves the server and users in the same region share one upstream fetch per tile.
+
+tile_cache_dir = os.environ.get('TILE_CACHE_DIR', '.tile_cache')
+#OpenWeather refreshes its map layers roughly every 10 minutes
+tile_ttl = 10 * 60
+#Per process. Processes sharing tile_cache_dir each count and evict only the tiles they fetched or found at startup,
+#so together they can use this many bytes each; workers.py divides the limit between its workers.
+tile_cache_max_bytes = int(os.environ.get('TILE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+tile_layers = {layer for (layer, name, show) in mapping.weather_layers}
+#Layers fetched ahead of time around a forecast location, the ones the map shows by default
+prefetch_layers = [layer for (layer, name, show) in mapping.weather_layers if show]
+
+
+#Disk cache of tile files with a time to live, evicting the least recently used tiles once over max_bytes
+class TileCache():
+    def __init__(self, directory, max_bytes, ttl):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        #path -> (size, fetched time), least recently used first
+        self._index = collections.OrderedDict()
+        self._load_index()
+
+    def _load_index(self):
+        found = []
+        for (root, dirs, files) in os.walk(self.directory):
+            for file_name in files:
+                if file_name.endswith('.png'):
+                    path = os.path.join(root, file_name)
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, path, stat.st_size))
+        for (mtime, path, size) in sorted(found):
+            self._index[path] = (size, mtime)
+            self.total_bytes += size
+
+    def path(self, layer, z, x, y):
+        return os.path.join(self.directory, layer, str(z), str(x), f'{y}.png')
+
+    def get(self, layer, z, x, y, now=None):
+        path = self.path(layer, z, x, y)
+        with self._lock:
+            entry = self._index.get(path)
+            if entry is not None:
+                self._index.move_to_end(path)
+        if entry is None:
+            entry = self._peer_tile(path)
+        if entry is None or entry[1] + self.ttl < (now or time.time()):
+            return None
+        try:
+            with open(path, 'rb') as tile_file:
+                return tile_file.read()
+        except FileNotFoundError:
+            self._forget(path)
+            return None
+
+    def put(self, layer, z, x, y, data):
+        path = self.path(layer, z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as tile_file:
+            tile_file.write(data)
+        os.replace(temporary_path, path)
+        with self._lock:
+            previous = self._index.pop(path, None)
+            if previous is not None:
+                self.total_bytes -= previous[0]
+            self._index[path] = (len(data), time.time())
+            self.total_bytes += len(data)
+            evicted = []
+            while self.total_bytes > self.max_bytes and len(self._index) > 1:
+                (old_path, (old_size, fetched)) = self._index.popitem(last=False)
+                self.total_bytes -= old_size
+                evicted.append(old_path)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+
+    #(size, fetched time) of a tile file another worker process sharing the directory wrote, or None. It is not
+    #indexed here, so its size and eviction stay with the process that fetched it.
+    def _peer_tile(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+    def _forget(self, path):
+        with self._lock:
+            entry = self._index.pop(path, None)
+            if entry is not None:
+                self.total_bytes -= entry[0]
+
+    def __len__(self):
+        return len(self._index)
+
+
+_tile_cache = None
+_tile_cache_lock = threading.Lock()
+coalescer = single_flight.SingleFlight()
+
+
+#The tile cache, indexed from the files on disk the first time. That walks the whole directory, so it is done in a
+#worker thread at startup, see main.py.
+def get_tile_cache():
+    global _tile_cache
+    with _tile_cache_lock:
+        if _tile_cache is None:
+            _tile_cache = TileCache(tile_cache_dir, tile_cache_max_bytes, tile_ttl)
+        return _tile_cache
+
+
+def cached_tile(layer, z, x, y):
+    return get_tile_cache().get(layer, z, x, y)
+
+
+def store_tile(layer, z, x, y, data):
+    get_tile_cache().put(layer, z, x, y, data)
+
+
+def download_tile(layer, z, x, y):
+    result = http_sessions.get_session('open_weather_tiles').get(
+        f'{get_weather.open_weather_tile_url}/map/{layer}/{z}/{x}/{y}.png',
+        {'appid': get_weather.get_open_weather_api_key()}, timeout=3)
+    result.raise_for_status()
+    return result.content
+
+
+async def _fetch_tile(layer, z, x, y):
+    data = await asyncio.to_thread(download_tile, layer, z, x, y)
+    await asyncio.to_thread(store_tile, layer, z, x, y, data)
+    return data
+
+
+#Tile bytes from the cache, or from OpenWeather with concurrent requests for the same tile sharing one download.
+#Tile files are read in a worker thread, off the event loop.
+async def get_tile(layer, z, x, y):
+    data = await asyncio.to_thread(cached_tile, layer, z, x, y)
+    if data is not None:
+        return data
+    return await coalescer.do((layer, z, x, y), _fetch_tile, layer, z, x, y)
+
+
+#Warms the cache with the 3x3 block of tiles around a location, which is what the map around it shows
+async def prefetch_neighbourhood(lat, lon, zoom=mapping.map_zoom, layers=None):
+    (tile_x, tile_y) = get_weather.tile_coordinates(lat, lon, zoom)
+    tile_count = 2 ** zoom
+    fetches = []
+    for layer in layers or prefetch_layers:
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if 0 <= tile_y + dy < tile_count:
+                    fetches.append(get_tile(layer, zoom, (tile_x + dx) % tile_count, tile_y + dy))
+    results = await asyncio.gather(*fetches, return_exceptions=True)
+    failures = [result for result in results if isinstance(result, BaseException)]
+    if failures:
+        print(f'Tile prefetch: {len(failures)} of {len(results)} tiles failed:', failures[0])
+
+
+@app.get('/tiles/{layer}/{z}/{x}/{y}.png')
+async def tile(layer: str, z: int, x: int, y: int):
+    if layer not in tile_layers or not (0 <= z <= 18 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=404, detail='Unknown tile')
+    try:
+        data = await get_tile(layer, z, x, y)
+    except Exception as e:
+        print('Tile proxy problem:', e)
+        raise HTTPException(status_code=502, detail='Could not fetch tile')
+    return Response(content=data, media_type='image/png', headers={'Cache-Control': f'public, max-age={tile_ttl}'})
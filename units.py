@@ -0,0 +1,32 @@
+import math
+
+#Forecasts are fetched and cached in one canonical unit and converted locally for display, so changing the display
+#unit never needs another round-trip to the providers.
+canonical_scale = 'C'
+temperature_scales = ['F', 'C', 'K']
+temperature_suffixes = {'F': u'\N{DEGREE SIGN}', 'C': u'\N{DEGREE SIGN}', 'K': ' K'}
+
+
+#Converts a canonical (Celsius) temperature to the given scale. Works on floats and NumPy arrays alike.
+def convert_temperature(celsius, scale):
+    if scale == 'C':
+        return celsius
+    elif scale == 'F':
+        return celsius * 9 / 5 + 32
+    elif scale == 'K':
+        return celsius + 273.15
+    raise ValueError('Unknown Temperature Scale')
+
+
+#Rounded display string for a canonical temperature, e.g. 21.6 -> '71°' for 'F'. Missing values are None or NaN.
+def format_temperature(celsius, scale, default='NaN'):
+    if celsius is None or math.isnan(celsius):
+        return default
+    return str(round(convert_temperature(celsius, scale))) + temperature_suffixes[scale]
+
+
+#Rounded percentage, e.g. 41.5 -> '42%'
+def format_percent(percent, default='NaN'):
+    if percent is None or math.isnan(percent):
+        return default
+    return str(round(percent)) + '%'
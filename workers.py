@@ -0,0 +1,89 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+#Runs several copies of the app on one host, one process per core, each on its own port behind a load balancer.
+#The processes share the forecast, geocode, alert zone, HTTP response and map tile caches through files in
+#--cache-dir, so a location fetched by one worker is served by all of them and upstream calls do not grow with the
+#number of workers, see shared_store.py. Page state lives in each process, so the load balancer must send a browser to
+#the same worker every time; the nginx upstream printed at start does that with ip_hash.
+#   python workers.py [--workers 4] [--port 8080] [--cache-dir .shared_cache]
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+#Environment variable -> file in the cache directory. Ones already set in the environment are left alone.
+shared_cache_files = {
+    'FORECAST_CACHE_DISK': 'forecast_cache.sqlite',
+    'GEOCODE_CACHE': 'geocode_cache.sqlite',
+    'ALERT_ZONE_CACHE': 'alert_zones.sqlite',
+    'HTTP_CACHE': 'http_cache',
+    'TILE_CACHE_DIR': 'tiles',
+}
+#Seconds workers get to exit after being asked to
+stop_timeout = 10
+#Size limit of the shared tile directory. Each worker evicts only the tiles it fetched, so it gets an equal share.
+tile_cache_max_bytes = int(os.environ.get('TILE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+
+def worker_environment(cache_dir, port, count):
+    environment = dict(os.environ)
+    for (name, file_name) in shared_cache_files.items():
+        environment.setdefault(name, os.path.join(cache_dir, file_name))
+    environment['TILE_CACHE_MAX_BYTES'] = str(tile_cache_max_bytes // count)
+    environment['PORT'] = str(port)
+    environment['RELOAD'] = '0'
+    return environment
+
+
+def nginx_upstream(ports, host='127.0.0.1'):
+    servers = ''.join(f'    server {host}:{port};\n' for port in ports)
+    return f'upstream weather_app {{\n    ip_hash;\n{servers}}}\n'
+
+
+def start_workers(count, first_port, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    workers = []
+    for port in range(first_port, first_port + count):
+        workers.append(subprocess.Popen([sys.executable, os.path.join(repo_dir, 'main.py')], cwd=repo_dir,
+                                        env=worker_environment(cache_dir, port, count)))
+        print(f'Worker {workers[-1].pid} on port {port}')
+    return workers
+
+
+def stop_workers(workers):
+    for worker in workers:
+        if worker.poll() is None:
+            worker.send_signal(signal.SIGINT)
+    deadline = time.monotonic() + stop_timeout
+    for worker in workers:
+        try:
+            worker.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            worker.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run several weather app processes sharing their caches')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--port', type=int, default=8080, help='port of the first worker, the rest count up')
+    parser.add_argument('--cache-dir', default=os.environ.get('SHARED_CACHE_DIR', '.shared_cache'))
+    args = parser.parse_args()
+
+    workers = start_workers(args.workers, args.port, os.path.abspath(args.cache_dir))
+    print('Sticky load balancing, e.g. for nginx:')
+    print(nginx_upstream(range(args.port, args.port + args.workers)))
+    try:
+        #A worker that dies takes its users' pages with it, so the rest are stopped too rather than limping on
+        while all(worker.poll() is None for worker in workers):
+            time.sleep(1)
+        print('A worker exited, stopping the others')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(workers)
+
+
+if __name__ == '__main__':
+    main()